@@ -0,0 +1,192 @@
+'''
+End-to-end texture cache benchmark.
+
+Times each stage of the thumbnail pipeline separately (entry parse,
+head read, body read, decode, QImage conversion, and per-thumbnail and
+batched signal delivery) and then the whole fetch_thumbnails run, and
+writes the results as a JSON baseline that later runs can be compared
+against.
+
+    $ python benchmark.py <texture.entries> --output baseline.json
+    $ python benchmark.py <texture.entries> --compare baseline.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+src_path = os.path.abspath(os.path.join(__file__, '../../src'))
+sys.path.append(src_path)
+
+from PyQt5 import QtCore
+from PyQt5.QtWidgets import QApplication
+
+from texturefetch import *
+
+
+class SignalSink(QtCore.QObject):
+
+    ''' Receives benchmark signals through a queued connection. '''
+
+    thumbnail_available = QtCore.pyqtSignal(TextureFetchThumbnail)
+    thumbnails_available = QtCore.pyqtSignal(list)
+
+    def __init__(self, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.received = 0
+        self.thumbnail_available.connect(self.receive, QtCore.Qt.QueuedConnection)
+        self.thumbnails_available.connect(self.receive_batch, QtCore.Qt.QueuedConnection)
+
+    def receive(self, thumbnail):
+        self.received += 1
+
+    def receive_batch(self, thumbnails):
+        self.received += len(thumbnails)
+
+
+class Stage(object):
+
+    ''' Times a benchmark stage. '''
+
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+        self.items = 0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start_time
+        self.results[self.name] = {
+            'seconds': seconds,
+            'items': self.items,
+            'items_per_second': self.items / seconds if seconds > 0 else None,
+        }
+
+
+def run_benchmark(entries_path, decode_sample=1000, worker_count=None, full_run=True):
+    ''' Runs every benchmark stage on a texture cache and returns the results. '''
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    fetcher = TextureCacheFetcher(entries_path, TEXTURE_CACHE_MEMORY_MAPPED)
+    stages = {}
+
+    with Stage(stages, 'entry_parse') as stage:
+        entry_file_contents = fetcher.load_entry_file_contents()
+        header = fetcher.load_header(entry_file_contents)
+        entries = fetcher.load_entries(entry_file_contents, header.entry_count)
+        uuids = entries.uuids
+        stage.items = len(entries)
+
+    with Stage(stages, 'head_read') as stage:
+        cache_file_contents = fetcher.load_cache_file_contents()
+        heads = [bytes(fetcher.load_texture_cache(cache_file_contents, i)) for i in range(len(entries))]
+        stage.items = len(heads)
+
+    sample = range(min(decode_sample, len(entries)))
+
+    with Stage(stages, 'body_read') as stage:
+        bodies = [fetcher.load_texture_body(uuids[i]) for i in sample]
+        stage.items = len(bodies)
+
+    codestreams = [heads[i] if body is None else heads[i] + body for i, body in zip(sample, bodies)]
+
+    with Stage(stages, 'decode') as stage:
+        images = [decode_j2c(uuids[i], codestream, thumbnail=True)
+                  for i, codestream in zip(sample, codestreams)]
+        stage.items = len(images)
+
+    with Stage(stages, 'qimage_conversion') as stage:
+        pixmaps = [ndarray_to_qpixmap(img) for img in images]
+        stage.items = len(pixmaps)
+
+    sink = SignalSink()
+    with Stage(stages, 'signal_delivery') as stage:
+        for i, pixmap in zip(sample, pixmaps):
+            sink.thumbnail_available.emit(TextureFetchThumbnail(entries[i], pixmap))
+        app.processEvents()
+        stage.items = sink.received
+
+    sink = SignalSink()
+    with Stage(stages, 'batch_delivery') as stage:
+        batcher = ThumbnailBatcher(sink.thumbnails_available.emit)
+        for i, pixmap in zip(sample, pixmaps):
+            batcher.add(TextureFetchThumbnail(entries[i], pixmap))
+        batcher.flush()
+        app.processEvents()
+        stage.items = sink.received
+
+    if full_run:
+        fetch_service = TextureCacheFetchService(fetcher, worker_count)
+        received = []
+        fetch_service.thumbnails_available.connect(received.extend)
+        with Stage(stages, 'full_run') as stage:
+            fetch_service.fetch_thumbnails()
+            stage.items = len(received)
+        fetch_service.decode_pool.shutdown()
+
+    return {
+        'entries_path': os.path.abspath(entries_path),
+        'entry_count': len(entries),
+        'decode_sample': len(sample),
+        'host': {
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpu_count': os.cpu_count(),
+        },
+        'stages': stages,
+    }
+
+
+def compare_results(results, baseline):
+    ''' Returns report lines comparing stage throughput with a baseline. '''
+
+    lines = []
+    for name, stage in results['stages'].items():
+        base_stage = baseline['stages'].get(name)
+        if base_stage is None or not base_stage['seconds'] or not stage['seconds']:
+            continue
+        lines.append('%-20s %10.3f s  baseline %10.3f s  speedup %6.2fx'
+                     % (name, stage['seconds'], base_stage['seconds'],
+                        base_stage['seconds'] / stage['seconds']))
+    return lines
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Benchmark texture cache loading.')
+    parser.add_argument('entries_path', help='path to the texture.entries file')
+    parser.add_argument('--decode-sample', type=int, default=1000,
+                        help='number of entries read, decoded and delivered in the stage benchmarks')
+    parser.add_argument('--workers', type=int, default=DECODE_WORKER_COUNT,
+                        help='number of decode worker processes for the full run')
+    parser.add_argument('--no-full-run', dest='full_run', action='store_false',
+                        help='skip the end-to-end fetch_thumbnails run')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare the results with this JSON baseline')
+    arguments = parser.parse_args(argv)
+
+    results = run_benchmark(arguments.entries_path, arguments.decode_sample,
+                            arguments.workers, arguments.full_run)
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print('\n'.join(compare_results(results, baseline)))
+    else:
+        print(json.dumps(results, indent=2))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+'''
+Synthetic texture cache generator.
+
+Writes a viewer-format texture cache of a configurable size: a valid
+texture.entries header and records, 600-byte heads in texture.cache and
+body files in the per-letter subdirectories. Codestreams are sampled
+from an existing cache (the mock cache by default) so the generated
+cache decodes like a real one.
+
+    $ python gencache.py <output directory> --entries 100000
+'''
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+src_path = os.path.abspath(os.path.join(__file__, '../../src'))
+sys.path.append(src_path)
+
+from texturefetch import *
+
+DEFAULT_TEMPLATE_ENTRIES_PATH = os.path.abspath(os.path.join(
+    __file__, '../../tests/mock_texturecache/texturecache/texture.entries'))
+DEFAULT_TIME_SPAN = 30 * 86400
+
+
+def load_template_codestreams(entries_path):
+    ''' Returns the complete codestreams of a texture cache
+    and the raw header bytes of its entries file. '''
+
+    fetcher = TextureCacheFetcher(entries_path)
+    entry_file_contents = fetcher.load_entry_file_contents()
+    cache_file_contents = fetcher.load_cache_file_contents()
+    header = fetcher.load_header(entry_file_contents)
+    entries = fetcher.load_entries(entry_file_contents, header.entry_count)
+
+    codestreams = []
+    for i in entries.valid_indices:
+        codestream = fetcher.load_codestream(cache_file_contents, i, entries.uuids[i])
+        if len(codestream) == entries[i].image_size > TEXTURE_CACHE_BYTE_COUNT:
+            codestreams.append(codestream)
+
+    if not codestreams:
+        raise TextureFetchException('No complete codestreams found in "%s".' % entries_path)
+
+    header_bytes = bytes(entry_file_contents[:fetcher.header_byte_count])
+    return header_bytes, codestreams
+
+
+def generate_cache(output_directory, entry_count, template_entries_path=DEFAULT_TEMPLATE_ENTRIES_PATH,
+                   time_span=DEFAULT_TIME_SPAN, seed=0):
+    ''' Generates a texture cache with entry_count entries written within
+    the last time_span seconds. Returns the path to its texture.entries. '''
+
+    header_bytes, codestreams = load_template_codestreams(template_entries_path)
+    random = np.random.RandomState(seed)
+
+    records = np.zeros(entry_count, dtype=ENTRY_DTYPE)
+    records['uuid'] = random.randint(0, 256, size=(entry_count, ENTRY_UUID_BYTE_COUNT))
+    templates = random.randint(0, len(codestreams), size=entry_count)
+    sizes = np.array([len(codestream) for codestream in codestreams], dtype=np.int32)
+    records['image_size'] = sizes[templates]
+    records['body_size'] = sizes[templates] - TEXTURE_CACHE_BYTE_COUNT
+    records['time'] = int(time.time()) - random.randint(0, max(time_span, 1), size=entry_count)
+
+    header = np.frombuffer(header_bytes, dtype=HEADER_DTYPE).copy()
+    header['entry_count'] = entry_count
+
+    for name in '0123456789abcdef':
+        subdirectory = os.path.join(output_directory, name)
+        if not os.path.exists(subdirectory):
+            os.makedirs(subdirectory)
+
+    entries_path = os.path.join(output_directory, 'texture.entries')
+    with open(entries_path, 'wb') as entries_file:
+        entries_file.write(header.tobytes())
+        entries_file.write(records.tobytes())
+
+    uuids = format_uuids_from_u8_array(records['uuid'])
+    with open(os.path.join(output_directory, 'texture.cache'), 'wb') as cache_file:
+        for uuid, template in zip(uuids, templates):
+            codestream = codestreams[template]
+            cache_file.write(codestream[:TEXTURE_CACHE_BYTE_COUNT])
+            body_path = os.path.join(output_directory, uuid[0], uuid + '.texture')
+            with open(body_path, 'wb') as body_file:
+                body_file.write(codestream[TEXTURE_CACHE_BYTE_COUNT:])
+
+    return entries_path
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic Second Life viewer texture cache.')
+    parser.add_argument('output_directory', help='directory to write the cache to')
+    parser.add_argument('--entries', type=int, default=10000, help='number of entries (default: 10000)')
+    parser.add_argument('--template', default=DEFAULT_TEMPLATE_ENTRIES_PATH,
+                        help='texture.entries of the cache to sample codestreams from')
+    parser.add_argument('--time-span', type=int, default=DEFAULT_TIME_SPAN,
+                        help='spread entry times over the last TIME_SPAN seconds')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    arguments = parser.parse_args(argv)
+
+    start_time = time.time()
+    entries_path = generate_cache(arguments.output_directory, arguments.entries,
+                                  arguments.template, arguments.time_span, arguments.seed)
+    print('Generated %i entries in %.1f s at "%s".'
+          % (arguments.entries, time.time() - start_time, entries_path))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,13 +17,73 @@ STDO_ENABLED = False
 WARN_ENABLED = True
 ERROR_ENABLED = True
 INFO_ENABLED = True
+INSTRUMENTATION_ENABLED = False
+INSTRUMENTATION_SUMMARY_INTERVAL = 10.0 # seconds
+
+# --- texture cache
+
+TEXTURE_CACHE_MEMORY_MAPPED = True
+TEXTURE_CACHE_HEAD_MAX_BYTES = 64 * 1024 * 1024
+BODY_READ_AHEAD_COUNT = 8 # body files read while earlier textures decode, 0 disables read-ahead
+BODY_READ_AHEAD_MAX_BYTES = 32 * 1024 * 1024 # cap on body bytes in flight
+BODY_READ_AHEAD_WORKER_COUNT = 4
+
+# --- decoding
+
+DECODE_WORKER_COUNT = None # None uses one worker per CPU
+BITMAP_CACHE_MAX_BYTES = 128 * 1024 * 1024
+THUMBNAIL_TARGET_SIZE = 128 # smallest long side, in pixels, thumbnails are reduced to
+THUMBNAIL_LAYER_FRACTION = 1.0 # share of quality layers decoded for thumbnails
+J2C_DECODER = None # 'pillow', 'imagecodecs' or 'glymur', None picks the fastest available
+J2C_DECODER_THREAD_COUNT = 1 # threads per decode where supported, decode workers already run in parallel
+J2C_DECODER_BENCHMARK_REPEAT = 3
+
+# --- thumbnail store
+
+THUMBNAIL_STORE_ENABLED = True
+THUMBNAIL_STORE_MAX_BYTES = 256 * 1024 * 1024
+
+# --- thumbnail delivery
+
+THUMBNAIL_BATCH_MAX_COUNT = 512
+THUMBNAIL_BATCH_MAX_INTERVAL = 0.1 # seconds between batches while decoding is slow
+
+# --- thumbnail view
+
+THUMBNAIL_ICON_SIZE = 128
+THUMBNAIL_PIXMAP_CACHE_MAX_BYTES = 64 * 1024 * 1024
+FAST_CACHE_THUMBNAILS = False # show the fast cache images instead of decoding thumbnails
+
+# --- preview
+
+PREVIEW_REDUCE_STEP = 2 # reduce levels refined by each progressive preview pass
+
+# --- scheduling
+
+SCHEDULER_SLICE_SECONDS = 0.02 # backend event loop turnaround between job runs
+PREFILL_ENABLED = True # decode the newest entries of the window into the thumbnail store in the background
+PREFILL_THUMBNAIL_BYTES = 4 * (2 * THUMBNAIL_TARGET_SIZE) ** 2 # largest RGBA thumbnail, caps prefill to the store
+
+# --- cache watcher
+
+WATCH_DEBOUNCE_MS = 500
+WATCH_MAX_DELAY_MS = 5000
 
 # --- paths
 
+import os
+
+APPLICATION_DATA_PATH = os.path.join(
+    os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.local', 'share'),
+    APPLICATION_NAME)
+THUMBNAIL_STORE_PATH = os.path.join(APPLICATION_DATA_PATH, 'thumbnails.sqlite')
+J2C_DECODER_CHOICE_PATH = os.path.join(APPLICATION_DATA_PATH, 'decoder.json')
+
 # --- arg override
 
 import sys
 args = sys.argv
 
 if 'debug' in args:
-    STDO_ENABLED = True
\ No newline at end of file
+    STDO_ENABLED = True
+    INSTRUMENTATION_ENABLED = True
\ No newline at end of file
@@ -35,14 +35,19 @@ class Application(QtWidgets.QApplication):
         # front to back
         self.presentation.set_cache_path.connect(self.backend.set_cache_path)
         self.presentation.refresh.connect(self.backend.refresh)
+        self.presentation.watch.connect(self.backend.set_watching)
         self.presentation.rebuild.connect(self.backend.rebuild)
         self.presentation.request_preview.connect(self.backend.preview_request)
+        self.presentation.cancel_preview.connect(self.backend.cancel_preview)
         self.presentation.request_save.connect(self.backend.save_bitmap)
+        self.presentation.thumbnail_view.request_thumbnails.connect(self.backend.request_thumbnails)
 
         # back to front
-        self.backend.thumbnail_available.connect(self.presentation.thumbnail_view.add_thumbnail)
+        self.backend.entries_available.connect(self.presentation.thumbnail_view.set_entries)
+        self.backend.thumbnails_available.connect(self.presentation.thumbnail_view.add_thumbnails)
         self.backend.bitmap_available.connect(self.presentation.save_bitmap)
         self.backend.preview_available.connect(self.presentation.show_preview)
+        self.backend.preview_failed.connect(self.presentation.preview_failed)
 
         # --- start backend thread
         self.backend_thread.start()
@@ -54,3 +59,6 @@ class Application(QtWidgets.QApplication):
     def execute(self):
         self.presentation.show()
         self.exec_()
+        self.backend_thread.quit()
+        self.backend_thread.wait()
+        self.backend.close()
@@ -4,15 +4,20 @@ Contains the main backend controller.
 
 from PyQt5 import QtCore
 
+from scheduler import *
 from texturefetch import *
+from thumbstore import ThumbnailStore
+from watcher import TextureCacheWatcher
 from utils import *
 
 
 class Backend(QtCore.QObject):
     
-    thumbnail_available = QtCore.pyqtSignal(str, object, int)
+    thumbnails_available = QtCore.pyqtSignal(list)
+    entries_available = QtCore.pyqtSignal(TextureFetchEntries)
     bitmap_available = QtCore.pyqtSignal(TextureFetchBitmap)
-    preview_available = QtCore.pyqtSignal(str, object)
+    preview_available = QtCore.pyqtSignal(str, object, int)
+    preview_failed = QtCore.pyqtSignal(str)
     operation_failed = QtCore.pyqtSignal(Exception)
     
 
@@ -20,43 +25,220 @@ class Backend(QtCore.QObject):
         QtCore.QObject.__init__(self, parent)
 
         # --- members
-        self.fetcher = TextureCacheFetcher('texture.entries')
-        self.fetch_service = TextureCacheFetchService(self.fetcher)
+        self.fetcher = TextureCacheFetcher('texture.entries', TEXTURE_CACHE_MEMORY_MAPPED)
+        self.thumbnail_store = None
+        if THUMBNAIL_STORE_ENABLED:
+            self.thumbnail_store = ThumbnailStore(THUMBNAIL_STORE_PATH, THUMBNAIL_STORE_MAX_BYTES,
+                                                  thumbnail_decode_variant())
+        self.fetch_service = TextureCacheFetchService(self.fetcher, DECODE_WORKER_COUNT,
+                                                      self.thumbnail_store)
+        self.watcher = TextureCacheWatcher(WATCH_DEBOUNCE_MS, WATCH_MAX_DELAY_MS, self)
+        self.scheduler = JobScheduler()
+        self.scheduler_timer = QtCore.QTimer(self)
+        self.previews = set()
+        self.thumbnail_streams = {
+            PRIORITY_VISIBLE: self.fetch_service.thumbnail_stream(FAST_CACHE_THUMBNAILS),
+            PRIORITY_PREFILL: self.fetch_service.prefill_stream(),
+        }
+        self.streaming = set()
 
         # --- signal/slot connection
         self.fetch_service.bitmap_available.connect(self.bitmap_available)
-        self.fetch_service.thumbnail_available.connect(self.send_fetched_thumbnail)
+        self.fetch_service.thumbnails_available.connect(self.send_fetched_thumbnails)
+        self.fetch_service.entries_available.connect(self.entries_available)
+        self.watcher.changed.connect(self.refresh)
+        self.scheduler_timer.timeout.connect(self.run_jobs)
 
+        # --- setup
+        self.scheduler_timer.setInterval(0)
 
-    def send_fetched_thumbnail(self, texture_fetch_thumbnail):
-        uuid = texture_fetch_thumbnail.uuid
-        thumbnail = texture_fetch_thumbnail.thumbnail
-        utime = texture_fetch_thumbnail.time
-        self.thumbnail_available.emit(uuid, thumbnail, utime)
+
+    def send_fetched_thumbnails(self, texture_fetch_thumbnails):
+        thumbnails = [(item.entry.index, item.uuid, item.thumbnail) for item in texture_fetch_thumbnails]
+        self.thumbnails_available.emit(thumbnails)
+
+    def schedule(self, priority, function, *args, newest_first=False):
+        self.scheduler.submit(priority, function, *args, newest_first=newest_first)
+        if not self.scheduler_timer.isActive():
+            self.scheduler_timer.start()
+
+    def stream_thumbnails(self, priority, indices):
+        ''' Queues entry indices on the thumbnail stream of a priority
+        class, scheduling its steps unless they already are. '''
+
+        if self.fetch_service.reader.last_update is None:
+            return
+        self.thumbnail_streams[priority].add(indices)
+        if priority not in self.streaming:
+            self.streaming.add(priority)
+            self.schedule(priority, self.step_thumbnail_stream, priority)
+
+    def step_thumbnail_stream(self, priority):
+        ''' Fetches one thumbnail of the stream of a priority class and
+        reschedules itself while more are left, so jobs of higher
+        priority classes run between thumbnails. '''
+
+        stream = self.thumbnail_streams[priority]
+        more = False
+        try:
+            more = stream.step()
+        except (TextureFetchException, Exception):
+            stream.cancel()
+            raise
+        finally:
+            if more:
+                self.schedule(priority, self.step_thumbnail_stream, priority)
+            else:
+                self.streaming.discard(priority)
+
+    @QtCore.pyqtSlot()
+    def run_jobs(self):
+        ''' Runs scheduled jobs for one time slice, returning to the event
+        loop in between so new requests are queued by priority. '''
+
+        self.scheduler.run_for(SCHEDULER_SLICE_SECONDS)
+        if len(self.scheduler) == 0:
+            self.scheduler_timer.stop()
+
+    def cancel_jobs(self, priorities=None):
+        ''' Cancels the scheduled jobs of the given priority classes,
+        or all of them. '''
+
+        count = self.scheduler.cancel(priorities)
+        if count:
+            INFO('Cancelled %i scheduled jobs.' % count)
+
+        for priority, stream in self.thumbnail_streams.items():
+            if priorities is None or priority in priorities:
+                stream.cancel()
+                self.streaming.discard(priority)
+
+        if priorities is None or PRIORITY_INTERACTIVE in priorities:
+            for uuid in self.previews:
+                self.preview_failed.emit(uuid)
+            self.previews.clear()
+
+    def cancel_thumbnail_jobs(self):
+        ''' Cancels thumbnail fetches and prefill, keeping
+        interactive previews and saves queued. '''
+
+        self.cancel_jobs((PRIORITY_VISIBLE, PRIORITY_PREFILL))
 
     def set_cache_path(self, path):
         INFO('Setting texture cache path as "%s"' % path)
-        self.fetch_service.set_fetcher(TextureCacheFetcher(path))
+        self.cancel_jobs()
+        previous_fetcher = self.fetcher
+        self.fetcher = TextureCacheFetcher(path, TEXTURE_CACHE_MEMORY_MAPPED)
+        self.fetch_service.set_fetcher(self.fetcher)
+        previous_fetcher.close()
+        if self.watcher.watching:
+            self.watcher.watch(self.fetcher.cache_directory)
+
+    def close(self):
+        ''' Releases the texture cache files and commits the thumbnail
+        store. Call once the backend thread has stopped. '''
+
+        self.cancel_jobs()
+        self.fetcher.close()
+        if self.thumbnail_store is not None:
+            self.thumbnail_store.close()
+
+    def set_watching(self, enabled):
+        if enabled:
+            self.watcher.watch(self.fetcher.cache_directory)
+        else:
+            INFO('Stopped watching texture cache.')
+            self.watcher.stop()
 
     def preview_request(self, uuid):
-        pixmap = self.fetch_service.fetch_bitmap(uuid)
-        self.preview_available.emit(uuid, pixmap)
+        self.previews.add(uuid)
+        self.schedule(PRIORITY_INTERACTIVE, self.send_preview, uuid)
+
+    @QtCore.pyqtSlot(str)
+    def cancel_preview(self, uuid):
+        self.previews.discard(uuid)
+
+    def send_preview(self, uuid, reduce_levels=None):
+        ''' Sends the first pass of a progressive preview and schedules
+        the next, refined one, until the preview is cancelled. Failed
+        passes end the preview through preview_failed. '''
+
+        if uuid not in self.previews:
+            return
+
+        try:
+            if reduce_levels is None:
+                reduce_levels = self.fetch_service.reader.preview_reduce_levels(uuid)
+            reduce = reduce_levels[0]
+            pixmap = self.fetch_service.fetch_bitmap(uuid, reduce)
+        except (TextureFetchException, Exception):
+            ERROR('Could not preview "%s".' % uuid, add_exception=True)
+            pixmap = None
+
+        if pixmap is None:
+            self.previews.discard(uuid)
+            self.preview_failed.emit(uuid)
+            return
+
+        self.preview_available.emit(uuid, pixmap, reduce)
+
+        if len(reduce_levels) > 1:
+            self.schedule(PRIORITY_INTERACTIVE, self.send_preview, uuid, reduce_levels[1:])
+        else:
+            self.previews.discard(uuid)
 
     def full_image_request(self, uuid):
         pixmap = self.fetch_service.fetch_bitmap(uuid)
         return pixmap
 
     def save_bitmap(self, uuid, path):
+        self.schedule(PRIORITY_INTERACTIVE, self.write_bitmap, uuid, path)
+
+    def write_bitmap(self, uuid, path):
         INFO('Saving "%s" to path "%s".' % (uuid, path))
         pixmap = self.fetch_service.fetch_bitmap(uuid)
-        pixmap.save(path)
+        if pixmap is None or pixmap.isNull():
+            WARN('Could not decode "%s" for saving.' % uuid)
+        elif not pixmap.save(path):
+            WARN('Could not save "%s" to path "%s".' % (uuid, path))
         
 
+    def request_thumbnails(self, indices):
+        self.stream_thumbnails(PRIORITY_VISIBLE, indices)
+
+    def schedule_prefill(self):
+        ''' Schedules decoding the entries selected by the last listing
+        (all of them on rebuild, the added and changed ones on refresh)
+        into the thumbnail store, newest first and no more than the
+        store holds, so prefill does not evict its own thumbnails. '''
+
+        if not PREFILL_ENABLED or FAST_CACHE_THUMBNAILS or self.thumbnail_store is None:
+            return
+        count = self.thumbnail_store.max_bytes // PREFILL_THUMBNAIL_BYTES
+        self.stream_thumbnails(PRIORITY_PREFILL, self.fetch_service.reader.last_update.indices[:count])
+
+    @QtCore.pyqtSlot()
     def refresh(self):
         INFO('Refreshing thumbnails.')
-        self.fetch_service.fetch_thumbnails(rebuild=False)
+        self.cancel_thumbnail_jobs()
+        if self.fetch_entries(rebuild=False):
+            self.schedule_prefill()
 
     def rebuild(self, seconds):
         INFO('Clearing.')
+        self.cancel_thumbnail_jobs()
         self.fetch_service.clear_local_cache()
-        self.fetch_service.fetch_thumbnails(max_time=seconds)
+        if self.fetch_entries(max_time=seconds):
+            self.schedule_prefill()
+
+    def fetch_entries(self, rebuild=True, max_time=None):
+        ''' Lists the texture cache entries. Unreadable or half-written
+        entry tables are logged and leave the previous listing in place.
+        Returns whether the entries were listed. '''
+
+        try:
+            self.fetch_service.fetch_entries(rebuild, max_time)
+        except (TextureFetchException, OSError, ValueError):
+            ERROR('Could not read texture cache "%s".' % self.fetcher.entries_path, add_exception=True)
+            return False
+        return True
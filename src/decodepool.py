@@ -0,0 +1,124 @@
+'''
+Contains the parallel texture decoding engine.
+'''
+
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from instrument import INSTRUMENTATION
+from j2c import decode_j2c, j2c_thumbnail_parameters, select_j2c_decoder, set_j2c_decoder
+
+
+def decode_texture_job(job):
+    ''' Decodes a (key, uuid, codestream, thumbnail) job to a (key, image)
+    result. Runs inside the worker processes. '''
+
+    key, uuid, codestream, thumbnail = job
+    return key, decode_j2c(uuid, codestream, thumbnail=thumbnail)
+
+
+def decode_thumbnail_job(job):
+    ''' Decodes a (uuid, codestream) job to a (uuid, thumbnail, seconds)
+    result. Runs inside the worker processes. '''
+
+    uuid, codestream = job
+    start_time = time.perf_counter()
+    thumbnail = decode_j2c(uuid, codestream, thumbnail=True)
+    return uuid, thumbnail, time.perf_counter() - start_time
+
+
+class CompletedJob(object):
+
+    ''' Wraps a result that needs no decoding so it can be passed
+    through map_unordered among the jobs that do. '''
+
+    __slots__ = ['result']
+
+    def __init__(self, result):
+        self.result = result
+
+
+class DecodePool(object):
+
+    ''' Runs decode jobs in a pool of worker processes. '''
+
+    def __init__(self, worker_count=None, pending_per_worker=4):
+
+        self.worker_count = worker_count or os.cpu_count() or 1
+        self.max_pending = self.worker_count * pending_per_worker
+        self.decoder = None
+        self._executor = None
+
+    @property
+    def executor(self):
+        ''' Returns the worker pool, starting it on first use. '''
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.worker_count,
+                                                 initializer=set_j2c_decoder,
+                                                 initargs=(self.decoder,))
+        return self._executor
+
+    def select_decoder(self, sample=None, thumbnail=False):
+        ''' Selects the decoder backend once, in this process, benchmarking
+        it on sample, a complete codestream, decoded as a thumbnail or
+        at full resolution. Workers started afterwards decode with it. '''
+
+        if self.decoder is None:
+            reduce, layers = (0, 0)
+            if thumbnail and sample is not None:
+                reduce, layers = j2c_thumbnail_parameters(sample)
+            self.decoder = select_j2c_decoder(sample, reduce, layers)
+            set_j2c_decoder(self.decoder)
+        return self.decoder
+
+    def decode(self, jobs):
+        ''' Decodes (uuid, codestream) jobs, yielding (uuid, thumbnail)
+        results as they complete. Worker decode times are recorded
+        as the decode stage. Completed jobs must wrap a
+        (uuid, thumbnail, None) result. '''
+
+        for uuid, thumbnail, seconds in self.map_unordered(decode_thumbnail_job, jobs):
+            if seconds is not None:
+                INSTRUMENTATION.record('decode', seconds)
+            yield uuid, thumbnail
+
+    def map_unordered(self, function, jobs):
+        ''' Runs function on every job, yielding results as they complete.
+
+        Jobs are consumed lazily and at most max_pending of them are in
+        flight at once, so memory stays bounded on large caches. The
+        function must be importable by the worker processes. Results of
+        CompletedJob jobs are yielded as they are reached. '''
+
+        if self.worker_count <= 1:
+            for job in jobs:
+                if isinstance(job, CompletedJob):
+                    yield job.result
+                else:
+                    yield function(job)
+            return
+
+        pending = set()
+        for job in jobs:
+            if isinstance(job, CompletedJob):
+                yield job.result
+                continue
+            pending.add(self.executor.submit(function, job))
+            if len(pending) >= self.max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+    def shutdown(self):
+        ''' Stops the worker processes. '''
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,189 @@
+'''
+Headless bulk export entry point.
+
+Exports a whole texture cache, or the textures written within the last
+--max-time seconds, to an output directory without starting the GUI.
+Already exported textures are skipped so an interrupted export can be
+resumed by running the same command again.
+
+    $ python export.py <texture.entries> <output directory> [--format png] [debug]
+'''
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+from decodepool import DecodePool
+from j2c import decode_j2c
+from texturecache import TextureCacheFetcher, TextureFetchException
+from utils import *
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+EXPORT_FORMATS = ('png', 'bmp', 'j2c')
+PROGRESS_INTERVAL = 5.0
+
+
+def export_texture_job(job):
+    ''' Writes a (uuid, codestream, path, export format) job to path,
+    decoding and encoding it unless exporting raw J2C. Returns (uuid, ok).
+    Runs inside the worker processes; errors fail the job, not the export. '''
+
+    uuid, codestream, path, export_format = job
+
+    # write next to the destination and rename so partial
+    # files never look exported to a resumed run
+    temp_path = path + '.part'
+
+    try:
+        if export_format == 'j2c':
+            with open(temp_path, 'wb') as output_file:
+                output_file.write(codestream)
+        else:
+            img = decode_j2c(uuid, codestream)
+            if img is None:
+                return uuid, False
+            image = Image.fromarray(img)
+            if image.mode not in ('L', 'RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            image.save(temp_path, format=export_format.upper())
+        os.replace(temp_path, path)
+
+    except Exception:
+        ERROR('Could not export "%s" to "%s".' % (uuid, path), add_exception=True)
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return uuid, False
+
+    return uuid, True
+
+
+class TextureCacheExporter(object):
+
+    ''' Exports texture cache entries to image files in parallel. '''
+
+    def __init__(self, fetcher, output_directory, export_format='png', worker_count=None):
+
+        self.fetcher = fetcher
+        self.output_directory = output_directory
+        self.export_format = export_format
+        self.decode_pool = DecodePool(worker_count)
+
+    def output_path(self, uuid):
+        return os.path.join(self.output_directory, '%s.%s' % (uuid, self.export_format))
+
+    def select_entries(self, max_time=None):
+        ''' Returns the entry table and the indices of entries to export. '''
+
+        entries = self.fetcher.load_entry_table()
+        return entries, entries.select_window(max_time)
+
+    def export_jobs(self, entries, indices, resume, skipped):
+        ''' Yields export jobs, reading codestreams as the pool asks for them. '''
+
+        cache_file_contents = self.fetcher.load_cache_file_contents()
+
+        for i in indices:
+            uuid = entries.uuids[i]
+            path = self.output_path(uuid)
+            if resume and os.path.exists(path):
+                skipped.append(uuid)
+                continue
+
+            codestream = self.fetcher.load_codestream(cache_file_contents, i, uuid,
+                                                      int(entries.records['image_size'][i]))
+            yield uuid, codestream, path, self.export_format
+
+    def export(self, max_time=None, resume=True, report=print):
+        ''' Exports the selected entries, reporting progress through report.
+        Returns the number of exported, skipped and failed textures. '''
+
+        if not os.path.exists(self.output_directory):
+            os.makedirs(self.output_directory)
+
+        entries, indices = self.select_entries(max_time)
+        total = len(indices)
+        self.decode_pool.select_decoder(
+            self.fetcher.load_benchmark_sample(self.fetcher.load_cache_file_contents(), entries))
+        skipped = []
+        exported = failed = 0
+
+        start_time = last_report = time.time()
+        jobs = self.export_jobs(entries, indices, resume, skipped)
+        results = self.decode_pool.map_unordered(export_texture_job, jobs)
+
+        try:
+            for uuid, ok in results:
+                if ok:
+                    exported += 1
+                else:
+                    failed += 1
+                    WARN('Could not export "%s".' % uuid)
+
+                now = time.time()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    report('Exported %i/%i textures (%.1f textures/s)'
+                           % (exported + len(skipped), total, exported / (now - start_time)))
+        finally:
+            results.close()
+            jobs.close()
+            self.decode_pool.shutdown()
+
+        elapsed = max(time.time() - start_time, 1e-6)
+        report('Exported %i textures in %.1f s (%.1f textures/s), skipped %i, failed %i.'
+               % (exported, elapsed, exported / elapsed, len(skipped), failed))
+
+        return exported, len(skipped), failed
+
+
+def parse_arguments(argv):
+
+    parser = argparse.ArgumentParser(description='Export textures from a Second Life viewer texture cache.')
+    parser.add_argument('entries_path', help='path to the texture.entries file')
+    parser.add_argument('output_directory', help='directory to export textures to')
+    parser.add_argument('--format', default='png', choices=EXPORT_FORMATS,
+                        help='export image format (default: png)')
+    parser.add_argument('--max-time', type=int, default=None,
+                        help='only export textures written within the last MAX_TIME seconds')
+    parser.add_argument('--workers', type=int, default=DECODE_WORKER_COUNT,
+                        help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--no-resume', dest='resume', action='store_false',
+                        help='export again textures that already exist in the output directory')
+
+    # 'debug' enables logging through appconfig
+    if argv is None:
+        argv = sys.argv[1:]
+    return parser.parse_args([arg for arg in argv if arg != 'debug'])
+
+
+def main(argv=None):
+
+    arguments = parse_arguments(argv)
+
+    if arguments.format != 'j2c' and Image is None:
+        print('Exporting to %s requires Pillow.' % arguments.format)
+        return 1
+
+    try:
+        fetcher = TextureCacheFetcher(arguments.entries_path, TEXTURE_CACHE_MEMORY_MAPPED)
+        exporter = TextureCacheExporter(fetcher, arguments.output_directory,
+                                        arguments.format, arguments.workers)
+        failed = exporter.export(arguments.max_time, arguments.resume)[2]
+    except (TextureFetchException, OSError) as e:
+        print('Export failed: %s' % e)
+        return 1
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,113 @@
+'''
+Contains a reader for the viewer's FastCache.cache file.
+
+The viewer keeps a small raw image of every texture cache entry in
+FastCache.cache, indexed like texture.cache, so low-resolution
+thumbnails can be shown without any JPEG2000 decode.
+'''
+
+import mmap
+import os
+
+import numpy as np
+
+from instrument import INSTRUMENTATION
+from utils import *
+
+FAST_CACHE_HEADER_BYTE_COUNT = 16
+FAST_CACHE_PIXELS_BYTE_COUNT = 1024
+
+FAST_CACHE_ENTRY_DTYPE = np.dtype([('width', '<i4'),
+                                   ('height', '<i4'),
+                                   ('components', '<i4'),
+                                   ('discard_level', '<i4'),
+                                   ('pixels', 'u1', FAST_CACHE_PIXELS_BYTE_COUNT)])
+
+FAST_CACHE_ENTRY_BYTE_COUNT = FAST_CACHE_HEADER_BYTE_COUNT + FAST_CACHE_PIXELS_BYTE_COUNT
+
+
+class FastCache(object):
+
+    ''' Fast cache records backed by a Numpy structured array.
+
+    The file is memory-mapped, so only the records actually read
+    become resident. Record headers are validated in bulk. A closed
+    fast cache holds no records. '''
+
+    def __init__(self, path, memory_mapped=True):
+
+        self.path = path
+        self.memory_mapped = memory_mapped
+        self._mapping = None
+        self.records = self.load_records()
+        self._valid = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def load_records(self):
+        ''' Loads the fast cache records. '''
+
+        with INSTRUMENTATION.stage('fast_cache_load'), open(self.path, 'rb') as fast_cache_file:
+            size = os.fstat(fast_cache_file.fileno()).st_size
+            count = size // FAST_CACHE_ENTRY_BYTE_COUNT
+
+            if count == 0:
+                return np.zeros(0, dtype=FAST_CACHE_ENTRY_DTYPE)
+
+            if self.memory_mapped:
+                contents = self._mapping = mmap.mmap(fast_cache_file.fileno(), 0,
+                                                     access=mmap.ACCESS_READ)
+            else:
+                contents = fast_cache_file.read()
+
+        INFO('Read %i entries from fast cache.' % count)
+
+        return np.frombuffer(contents, dtype=FAST_CACHE_ENTRY_DTYPE, count=count)
+
+    def close(self):
+        ''' Drops the records and closes the file mapping. A mapping
+        still viewed elsewhere is closed once its views are collected. '''
+
+        self.records = np.zeros(0, dtype=FAST_CACHE_ENTRY_DTYPE)
+        self._valid = None
+        if self._mapping is not None:
+            try:
+                self._mapping.close()
+            except BufferError:
+                pass
+            self._mapping = None
+
+    @property
+    def valid(self):
+        ''' Returns a mask of records holding a usable image. '''
+
+        if self._valid is None:
+            width = self.records['width']
+            height = self.records['height']
+            components = self.records['components']
+            self._valid = ((width > 0) & (height > 0) &
+                           (components >= 1) & (components <= 4) &
+                           (width.astype(np.int64) * height * components <= FAST_CACHE_PIXELS_BYTE_COUNT))
+        return self._valid
+
+    def get(self, index):
+        ''' Returns the image of a record as an ndarray, or None if the
+        record is missing or invalid. '''
+
+        if index >= len(self.records) or not self.valid[index]:
+            return None
+
+        record = self.records[index]
+        width = int(record['width'])
+        height = int(record['height'])
+        components = int(record['components'])
+
+        img = record['pixels'][:width*height*components].reshape(height, width, components)
+
+        # rows are stored bottom-up
+        img = img[::-1]
+
+        if components <= 2:
+            img = img[:, :, 0]
+        return np.ascontiguousarray(img)
@@ -0,0 +1,143 @@
+'''
+Contains lightweight timing instrumentation for the fetch pipeline.
+'''
+
+import math
+import threading
+import time
+
+from utils import *
+
+HISTOGRAM_BUCKET_COUNT = 32
+
+
+class StageTimer(object):
+
+    ''' Context manager recording the duration of one stage run. '''
+
+    __slots__ = ['instrumentation', 'name', 'start_time']
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.record(self.name, time.perf_counter() - self.start_time)
+
+
+class NullStageTimer(object):
+
+    ''' Context manager used while instrumentation is disabled. '''
+
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_STAGE_TIMER = NullStageTimer()
+
+
+class StageStatistics(object):
+
+    ''' Run count, total time and latency histogram of a stage.
+
+    Histogram bucket i counts runs that took less than 2**i microseconds
+    (and at least 2**(i-1)); the last bucket also holds anything slower. '''
+
+    __slots__ = ['count', 'total_seconds', 'histogram']
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.histogram = [0] * HISTOGRAM_BUCKET_COUNT
+
+    def add(self, seconds):
+        self.count += 1
+        self.total_seconds += seconds
+        bucket = math.frexp(seconds * 1e6)[1] if seconds > 0 else 0
+        self.histogram[min(max(bucket, 0), HISTOGRAM_BUCKET_COUNT - 1)] += 1
+
+    def as_dict(self):
+        return {'count': self.count,
+                'total_seconds': self.total_seconds,
+                'mean_seconds': self.total_seconds / self.count if self.count else 0.0,
+                'histogram_us': {1 << i: count for i, count in enumerate(self.histogram) if count}}
+
+
+class Instrumentation(object):
+
+    ''' Collects per-stage timings.
+
+    While disabled, stage() hands out a shared no-op context manager and
+    nothing is recorded, so instrumented code runs at close to full speed.
+    Stages may be recorded from any thread, such as the read-ahead
+    threads. '''
+
+    def __init__(self, enabled=False, summary_interval=10.0):
+
+        self.enabled = enabled
+        self.summary_interval = summary_interval
+        self.stages = {}
+        self.last_summary_time = time.time()
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        ''' Returns a context manager timing a run of the named stage. '''
+
+        if not self.enabled:
+            return NULL_STAGE_TIMER
+        return StageTimer(self, name)
+
+    def record(self, name, seconds):
+        ''' Records a run of the named stage. '''
+
+        if not self.enabled:
+            return
+        with self._lock:
+            try:
+                statistics = self.stages[name]
+            except KeyError:
+                statistics = self.stages[name] = StageStatistics()
+            statistics.add(seconds)
+
+    def snapshot(self):
+        ''' Returns the statistics of every stage. '''
+
+        with self._lock:
+            return {name: statistics.as_dict() for name, statistics in self.stages.items()}
+
+    def reset(self):
+        ''' Discards the recorded statistics. '''
+
+        with self._lock:
+            self.stages = {}
+
+    def summary(self):
+        ''' Returns a one-line summary of the recorded statistics. '''
+
+        with self._lock:
+            parts = ['%s %i/%.3fs' % (name, statistics.count, statistics.total_seconds)
+                     for name, statistics in sorted(self.stages.items())]
+        return 'Stage timings (count/total): %s' % (', '.join(parts) or 'none')
+
+    def log_summary(self, force=False):
+        ''' Logs the summary line once every summary_interval seconds. '''
+
+        if not self.enabled:
+            return
+
+        now = time.time()
+        if force or now - self.last_summary_time >= self.summary_interval:
+            self.last_summary_time = now
+            INFO(self.summary())
+
+
+INSTRUMENTATION = Instrumentation(INSTRUMENTATION_ENABLED, INSTRUMENTATION_SUMMARY_INTERVAL)
@@ -0,0 +1,515 @@
+'''
+Contains JPEG2000 codestream (J2C) decoding helpers.
+'''
+
+import abc
+import io
+import json
+import math
+import os
+import tempfile
+import time
+
+import glymur
+import numpy as np
+
+from utils import *
+
+try:
+    from PIL import Image, ImageFile, features
+    PILLOW_J2C_AVAILABLE = features.check('jpg_2000')
+    # Cached textures are often truncated (head only or a partial body),
+    # so they are decoded as far as they go, like OpenJPEG does, instead
+    # of being rejected. Pillow only has this process-wide switch, which
+    # is set once here as toggling it per decode races between threads.
+    ImageFile.LOAD_TRUNCATED_IMAGES = True
+except ImportError:
+    Image = None
+    PILLOW_J2C_AVAILABLE = False
+
+try:
+    import imagecodecs
+except ImportError:
+    imagecodecs = None
+
+
+class J2CDecoderException(Exception):
+    pass
+
+
+def decode_j2c(uuid, j2c_contents, thumbnail=False, reduce=0):
+    ''' Decodes raw J2C contents to a Numpy ndarray, reduced reduce times.
+
+    Thumbnails are decoded at the reduce level and quality layer count
+    picked from the codestream header for THUMBNAIL_TARGET_SIZE.
+    Decodes with the backend picked by get_j2c_decoder. Returns None
+    on failure. '''
+
+    layers = 0
+    if thumbnail:
+        reduce, layers = j2c_thumbnail_parameters(j2c_contents)
+
+    decoder = get_j2c_decoder()
+
+    try:
+        return decoder.decode(j2c_contents, reduce, layers)
+    except Exception:
+        WARN('Could not decode "%s". Texture stream may be incomplete.' % uuid)
+        return None
+
+
+def thumbnail_decode_parameters(width, height, levels, layers,
+                                target_size=THUMBNAIL_TARGET_SIZE,
+                                layer_fraction=THUMBNAIL_LAYER_FRACTION):
+    ''' Returns the (reduce, layers) decoding a texture to the smallest
+    size still at least target_size on its long side, within its
+    decomposition levels. A layers value of 0 decodes every layer. '''
+
+    size = max(width, height)
+    reduce = 0
+    while reduce < levels and size >> (reduce + 1) >= target_size:
+        reduce += 1
+
+    decode_layers = 0
+    if layer_fraction < 1.0 and layers > 1:
+        decode_layers = max(1, int(math.ceil(layers * layer_fraction)))
+
+    return reduce, decode_layers
+
+
+def j2c_thumbnail_parameters(j2c_contents):
+    ''' Returns the thumbnail_decode_parameters of a codestream,
+    or (0, 0) if its header cannot be read. '''
+
+    header = read_j2c_header(j2c_contents)
+    if header is None:
+        return 0, 0
+    return thumbnail_decode_parameters(int(header['width']), int(header['height']),
+                                       int(header['levels']), int(header['layers']))
+
+
+def thumbnail_decode_variant():
+    ''' Returns a string identifying the thumbnail decode settings. '''
+
+    return 'target=%i,layers=%g' % (THUMBNAIL_TARGET_SIZE, THUMBNAIL_LAYER_FRACTION)
+
+
+def decode_j2c_in_memory(j2c_contents, reduce=0, layers=0):
+    ''' Decodes J2C contents in-memory with Pillow.
+
+    Truncated codestreams are decoded as far as they go, see
+    LOAD_TRUNCATED_IMAGES above. '''
+
+    img = Image.open(CodestreamReader(j2c_contents))
+    img.reduce = reduce
+    img.layers = layers
+
+    img.load()
+    return np.asarray(img)
+
+
+class CodestreamReader(io.RawIOBase):
+
+    ''' Seekable read-only stream over a bytes-like codestream.
+
+    io.BytesIO copies anything but bytes up front, so reassembled
+    bytearray codestreams are read through a memoryview instead. '''
+
+    def __init__(self, contents):
+        self.view = memoryview(contents).cast('B')
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        self.position = max(offset, 0)
+        return self.position
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else self.position + size
+        data = self.view[self.position:end].tobytes()
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer):
+        with memoryview(buffer).cast('B') as target:
+            size = max(min(len(target), len(self.view) - self.position), 0)
+            target[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+
+
+def decode_j2c_from_temp_file(j2c_contents, reduce=0, layers=0):
+    ''' Decodes J2C contents with Glymur through a temporary file. '''
+
+    tmpfile, temp_path = tempfile.mkstemp()
+    try:
+        with os.fdopen(tmpfile, 'wb') as tmpfile:
+            tmpfile.write(j2c_contents)
+
+        step = 1 << reduce
+        jp2 = glymur.Jp2k(temp_path)
+        if layers:
+            jp2.layer = layers - 1
+        return jp2[::step, ::step]
+
+    finally:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            WARN('Could not remove temp file "%s".' % temp_path)
+
+
+# --- decoder backends
+
+class J2CDecoder(abc.ABC):
+
+    ''' JPEG2000 decoding backend.
+
+    Subclasses wrap one decoding library and report what it supports:
+    in-memory input, decoding at a reduce level, limiting the decoded
+    quality layers and decoding a single image on several threads. '''
+
+    name = None
+    in_memory = False
+    reduce = False
+    layers = False
+    threaded = False
+
+    def __init__(self, thread_count=J2C_DECODER_THREAD_COUNT):
+        self.thread_count = thread_count
+
+    @classmethod
+    @abc.abstractmethod
+    def available(cls):
+        ''' Returns whether the library is usable on this host. '''
+
+    @classmethod
+    def capabilities(cls):
+        return {'in_memory': cls.in_memory, 'reduce': cls.reduce,
+                'layers': cls.layers, 'threaded': cls.threaded}
+
+    @abc.abstractmethod
+    def decode(self, j2c_contents, reduce=0, layers=0):
+        ''' Decodes J2C contents to an ndarray, reduced reduce times and
+        limited to layers quality layers unless layers is 0. '''
+
+
+class PillowJ2CDecoder(J2CDecoder):
+
+    name = 'pillow'
+    in_memory = True
+    reduce = True
+    layers = True
+
+    @classmethod
+    def available(cls):
+        return PILLOW_J2C_AVAILABLE
+
+    def decode(self, j2c_contents, reduce=0, layers=0):
+        return decode_j2c_in_memory(j2c_contents, reduce, layers)
+
+
+class GlymurJ2CDecoder(J2CDecoder):
+
+    name = 'glymur'
+    reduce = True
+    layers = True
+    threaded = True
+
+    def __init__(self, thread_count=J2C_DECODER_THREAD_COUNT):
+        J2CDecoder.__init__(self, thread_count)
+        if thread_count > 1:
+            glymur.set_option('lib.num_threads', thread_count)
+
+    @classmethod
+    def available(cls):
+        return (getattr(glymur.lib.openjp2, 'OPENJP2', None) is not None and
+                glymur.version.openjpeg_version != '0.0.0')
+
+    def decode(self, j2c_contents, reduce=0, layers=0):
+        return decode_j2c_from_temp_file(j2c_contents, reduce, layers)
+
+
+class ImagecodecsJ2CDecoder(J2CDecoder):
+
+    ''' Decodes with imagecodecs' OpenJPEG bindings, which decode every
+    layer at full resolution; reduced images are subsampled. '''
+
+    name = 'imagecodecs'
+    in_memory = True
+    threaded = True
+
+    @classmethod
+    def available(cls):
+        return imagecodecs is not None and getattr(imagecodecs, 'JPEG2K', None) is not None \
+            and imagecodecs.JPEG2K.available
+
+    def decode(self, j2c_contents, reduce=0, layers=0):
+        img = imagecodecs.jpeg2k_decode(j2c_contents, numthreads=self.thread_count)
+        if reduce:
+            step = 1 << reduce
+            img = np.ascontiguousarray(img[::step, ::step])
+        return img
+
+
+J2C_DECODERS = {decoder.name: decoder for decoder in
+                (PillowJ2CDecoder, ImagecodecsJ2CDecoder, GlymurJ2CDecoder)}
+
+_j2c_decoder = None
+
+
+def available_j2c_decoders():
+    ''' Returns the names of the backends usable on this host,
+    in order of preference. '''
+
+    return [name for name, decoder in J2C_DECODERS.items() if decoder.available()]
+
+
+def get_j2c_decoder():
+    ''' Returns the decoder backend of this process. Unless one was set
+    with set_j2c_decoder, it is selected on first use without a
+    benchmark. '''
+
+    if _j2c_decoder is None:
+        set_j2c_decoder(select_j2c_decoder())
+    return _j2c_decoder
+
+
+def set_j2c_decoder(name):
+    ''' Sets the decoder backend of this process by name, or clears it
+    when name is None. Decode worker processes are initialized with it
+    so the backend is selected once, in the parent. '''
+
+    global _j2c_decoder
+    _j2c_decoder = None if name is None else J2C_DECODERS[name]()
+
+
+def select_j2c_decoder(sample=None, reduce=0, layers=0, name=J2C_DECODER, choice_path=None):
+    ''' Returns the name of the backend to decode with.
+
+    A configured name wins if it is available. Otherwise the choice
+    saved at choice_path, J2C_DECODER_CHOICE_PATH by default, is reused
+    while the same backends are available, or the fastest correct
+    backend decoding sample is picked and saved. sample must be a
+    complete codestream, as backends failing on it are ruled out.
+    Without a usable benchmark result Pillow is used, without saving
+    the choice. '''
+
+    if choice_path is None:
+        choice_path = J2C_DECODER_CHOICE_PATH
+
+    available = available_j2c_decoders()
+    if not available:
+        raise J2CDecoderException('No JPEG2000 decoder is available.')
+
+    if name is not None:
+        if name in available:
+            return name
+        WARN('Configured JPEG2000 decoder "%s" is not available.' % name)
+
+    try:
+        with open(choice_path, 'r') as choice_file:
+            choice = json.load(choice_file)
+        if choice['available'] == available and choice['decoder'] in available:
+            return choice['decoder']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    timings = {}
+    if sample is not None and len(available) > 1:
+        timings = benchmark_j2c_decoders(sample, reduce, layers, available)
+    elif len(available) == 1:
+        timings = {available[0]: 0.0}
+
+    correct = {decoder: seconds for decoder, seconds in timings.items() if seconds is not None}
+    if not correct:
+        return PillowJ2CDecoder.name if PillowJ2CDecoder.name in available else available[0]
+
+    selected = min(correct, key=correct.get)
+    INFO('Selected JPEG2000 decoder "%s" (%s).' % (selected, ', '.join(
+        '%s: %s' % (decoder, 'failed' if seconds is None else '%.2f ms' % (seconds * 1000))
+        for decoder, seconds in timings.items())))
+
+    try:
+        save_j2c_decoder_choice(choice_path, {'decoder': selected, 'available': available,
+                                              'timings': timings})
+    except OSError:
+        WARN('Could not save JPEG2000 decoder choice to "%s".' % choice_path)
+
+    return selected
+
+
+def save_j2c_decoder_choice(choice_path, choice):
+    ''' Writes a decoder choice through a temporary file of its own,
+    so concurrent writers never interleave. '''
+
+    directory = os.path.dirname(choice_path)
+    os.makedirs(directory, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(choice_path) + '.',
+                                         dir=directory)
+    try:
+        with os.fdopen(handle, 'w') as choice_file:
+            json.dump(choice, choice_file)
+        os.replace(temp_path, choice_path)
+    except Exception:
+        os.unlink(temp_path)
+        raise
+
+
+def benchmark_j2c_decoders(sample, reduce=0, layers=0, names=None,
+                           repeat=J2C_DECODER_BENCHMARK_REPEAT):
+    ''' Times the backends decoding sample. Returns {name: seconds}
+    with the best of repeat runs, or None where a backend failed or
+    decoded to a shape other than the codestream header's. Failing
+    backends are skipped after a single untimed trial decode. '''
+
+    header = read_j2c_header(sample)
+    expected_shape = None
+    if header is not None:
+        step = 1 << reduce
+        expected_shape = (-(-int(header['height']) // step), -(-int(header['width']) // step))
+
+    timings = {}
+    for name in names or available_j2c_decoders():
+        decoder = J2C_DECODERS[name]()
+        try:
+            img = decoder.decode(sample, reduce, layers)
+        except Exception:
+            WARN('JPEG2000 decoder "%s" could not decode the benchmark sample.' % name)
+            timings[name] = None
+            continue
+
+        if expected_shape is not None and tuple(img.shape[:2]) != expected_shape:
+            timings[name] = None
+            continue
+
+        best = None
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            decoder.decode(sample, reduce, layers)
+            seconds = time.perf_counter() - start_time
+            best = seconds if best is None else min(best, seconds)
+        timings[name] = best
+
+    return timings
+
+
+# --- codestream headers
+
+J2C_SOC_SIZ = b'\xff\x4f\xff\x51'
+J2C_COD_MARKER = 0xff52
+J2C_SOT_MARKER = 0xff90
+J2C_SIZ_OFFSET = 2
+J2C_SIZ_COMPONENTS_OFFSET = 42
+J2C_HEAD_BYTE_COUNT = 600 # bytes searched for the main header of a single codestream
+
+# main header fields up to the first component, at fixed offsets
+J2C_SIZ_DTYPE_FIELDS = {'names': ['soc_siz', 'lsiz', 'rsiz', 'xsiz', 'ysiz', 'xosiz', 'yosiz',
+                                  'xtsiz', 'ytsiz', 'xtosiz', 'ytosiz', 'csiz', 'ssiz'],
+                        'formats': ['S4', '>u2', '>u2', '>u4', '>u4', '>u4', '>u4',
+                                    '>u4', '>u4', '>u4', '>u4', '>u2', 'u1'],
+                        'offsets': [0, 4, 6, 8, 12, 16, 20, 24, 28, 32, 36, 40, 42]}
+
+J2C_METADATA_DTYPE = np.dtype([('valid', '?'),
+                               ('width', '<u4'),
+                               ('height', '<u4'),
+                               ('components', '<u2'),
+                               ('bit_depth', '<u1'),
+                               ('tile_width', '<u4'),
+                               ('tile_height', '<u4'),
+                               ('tile_count', '<u4'),
+                               ('layers', '<u2'),
+                               ('levels', '<u1')]) # decomposition levels, one less than resolutions
+
+
+def parse_j2c_heads(contents, count, stride):
+    ''' Parses the SIZ and COD main header markers of count codestream
+    heads laid out every stride bytes in contents, without decoding.
+
+    SIZ fields are read in bulk through a strided structured view. COD
+    normally follows SIZ directly and is read in bulk as well; heads with
+    other markers in between are walked one by one. Returns an array of
+    J2C_METADATA_DTYPE records, invalid where no SIZ marker was found. '''
+
+    metadata = np.zeros(count, dtype=J2C_METADATA_DTYPE)
+    if count == 0:
+        return metadata
+
+    siz_dtype = np.dtype(dict(J2C_SIZ_DTYPE_FIELDS, itemsize=stride))
+    siz = np.frombuffer(contents, dtype=siz_dtype, count=count)
+    heads = np.frombuffer(contents, dtype=np.uint8, count=count * stride).reshape(count, stride)
+
+    valid = siz['soc_siz'] == J2C_SOC_SIZ
+    valid &= (siz['csiz'] > 0) & (siz['xtsiz'] > 0) & (siz['ytsiz'] > 0)
+
+    metadata['width'] = siz['xsiz'] - siz['xosiz']
+    metadata['height'] = siz['ysiz'] - siz['yosiz']
+    metadata['components'] = siz['csiz']
+    metadata['bit_depth'] = (siz['ssiz'] & 0x7f) + 1
+    metadata['tile_width'] = siz['xtsiz']
+    metadata['tile_height'] = siz['ytsiz']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tiles_x = -(-(siz['xsiz'].astype(np.int64) - siz['xtosiz']) // np.maximum(siz['xtsiz'], 1))
+        tiles_y = -(-(siz['ysiz'].astype(np.int64) - siz['ytosiz']) // np.maximum(siz['ytsiz'], 1))
+    metadata['tile_count'] = np.clip(tiles_x * tiles_y, 0, None)
+
+    # COD marker right after SIZ: marker, Lcod, Scod, progression, layers (2), MCT, levels
+    cod = J2C_SIZ_OFFSET + 2 + siz['lsiz'].astype(np.intp)
+    inline = valid & (cod + 10 <= stride)
+    rows = np.flatnonzero(inline)
+    cod_rows = cod[rows]
+    marker = heads[rows, cod_rows].astype(np.uint16) << 8 | heads[rows, cod_rows + 1]
+    found = rows[marker == J2C_COD_MARKER]
+    cod_found = cod[found]
+    metadata['layers'][found] = heads[found, cod_found + 6].astype(np.uint16) << 8 | heads[found, cod_found + 7]
+    metadata['levels'][found] = heads[found, cod_found + 9]
+
+    for i in np.flatnonzero(valid & ~np.isin(np.arange(count), found)):
+        fields = find_j2c_cod(bytes(heads[i]), int(cod[i]))
+        if fields is not None:
+            metadata['layers'][i], metadata['levels'][i] = fields
+
+    metadata['valid'] = valid
+    return metadata
+
+
+def read_j2c_header(j2c_contents):
+    ''' Returns the J2C_METADATA_DTYPE record of a single codestream,
+    or None if its main header could not be parsed. '''
+
+    head = bytes(j2c_contents[:J2C_HEAD_BYTE_COUNT])
+    if len(head) < J2C_SIZ_COMPONENTS_OFFSET + 1:
+        return None
+
+    header = parse_j2c_heads(head, 1, len(head))[0]
+    return header if header['valid'] else None
+
+
+def find_j2c_cod(head, offset):
+    ''' Walks the main header marker segments from offset and returns
+    the (layers, levels) of the COD marker, or None if it is not
+    within the head. '''
+
+    while offset + 4 <= len(head):
+        marker = int.from_bytes(head[offset:offset + 2], 'big')
+        if marker == J2C_SOT_MARKER:
+            return None
+        if marker == J2C_COD_MARKER:
+            if offset + 10 > len(head):
+                return None
+            return int.from_bytes(head[offset + 6:offset + 8], 'big'), head[offset + 9]
+        offset += 2 + int.from_bytes(head[offset + 2:offset + 4], 'big')
+
+    return None
@@ -0,0 +1,86 @@
+'''
+Contains a byte-budgeted least recently used cache.
+'''
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    ''' Mapping bounded by the total byte size of its values.
+
+    The least recently used values are evicted once max_bytes is
+    exceeded. Hits, misses and evictions are counted. '''
+
+    def __init__(self, max_bytes, sizeof=len):
+
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.byte_count = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._values = OrderedDict()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def keys(self):
+        return self._values.keys()
+
+    def get(self, key):
+        ''' Returns the value for key, or None on a miss. '''
+
+        try:
+            value = self._values[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self._values.move_to_end(key)
+        self.hits += 1
+        return value[0]
+
+    def put(self, key, value):
+        ''' Stores value for key, evicting as needed. Values larger
+        than the whole budget are not stored. '''
+
+        self.discard(key)
+
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        self._values[key] = (value, size)
+        self.byte_count += size
+
+        while self.byte_count > self.max_bytes:
+            _, (_, evicted_size) = self._values.popitem(last=False)
+            self.byte_count -= evicted_size
+            self.evictions += 1
+
+    def discard(self, key):
+        ''' Removes key if present. '''
+
+        value = self._values.pop(key, None)
+        if value is not None:
+            self.byte_count -= value[1]
+
+    def clear(self):
+        ''' Removes every value. Counters are kept. '''
+
+        self._values.clear()
+        self.byte_count = 0
+
+    @property
+    def statistics(self):
+        ''' Returns the cache counters. '''
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._values),
+                'bytes': self.byte_count}
@@ -3,7 +3,9 @@
 Main entry point for program.
 '''
 
+import multiprocessing
 import sys
+import traceback
 from PyQt5 import QtCore
 from application import Application
 
@@ -15,5 +17,6 @@ if QtCore.QT_VERSION >= 0x50501:
     sys.excepthook = excepthook
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     app = Application()
     app.execute()
@@ -0,0 +1,75 @@
+'''
+Contains Qt conversion helpers.
+(ndarray/J2C to QImage/QPixmap, clipboard)
+
+Kept apart from utils and j2c so the texture cache
+can be read and decoded without importing Qt.
+'''
+
+from tkinter import Tk
+from traceback import format_exc
+
+import numpy as np
+from PyQt5.QtGui import QImage, QPixmap, qRgb
+
+from j2c import decode_j2c
+from utils import *
+
+gray_color_table = [qRgb(i, i, i) for i in range(256)]
+
+
+def convert_j2c_to_qpixmap(uuid, j2c_contents, thumbnail=False):
+    '''Converts the raw binary J2C file contents to a Qt pixmap.
+
+    NOTE: A QApplication MUST be instantiated before running this!'''
+
+    inmem_img = decode_j2c(uuid, j2c_contents, thumbnail=thumbnail)
+    return ndarray_to_qpixmap(inmem_img)
+
+
+def ndarray_to_qpixmap(img):
+    '''Converts a decoded ndarray to a Qt pixmap, passing None through.
+
+    NOTE: A QApplication MUST be instantiated before running this!'''
+
+    if img is None:
+        return None
+
+    return QPixmap(ndarray_to_qimage(img))
+
+
+def ndarray_to_qimage(im, copy=False):
+    ''' Converts a Numpy ndarray to a QImage.
+    Credit: https://gist.github.com/smex/5287589'''
+
+    try:
+        if im is None:
+            return QImage()
+
+        if im.dtype == np.uint8:
+            if len(im.shape) == 2:
+                qim = QImage(im.data, im.shape[1], im.shape[0], im.strides[0], QImage.Format_Indexed8)
+                qim.setColorTable(gray_color_table)
+                return qim.copy() if copy else qim
+
+            elif len(im.shape) == 3:
+                if im.shape[2] == 3:
+                    qim = QImage(im.data, im.shape[1], im.shape[0], im.strides[0], QImage.Format_RGB888);
+                    return qim.copy() if copy else qim
+                elif im.shape[2] == 4:
+                    qim = QImage(im.data, im.shape[1], im.shape[0], im.strides[0], QImage.Format_ARGB32);
+                    return qim.copy() if copy else qim
+
+        return QImage()
+    except Exception as e:
+        WARN('Unknown error converting ndarray to pixmap.\n%s' % format_exc())
+        return QImage()
+
+def copy_str_to_clipboard(msg):
+    '''Copies a string to the system clipboard.'''
+    r = Tk()
+    r.withdraw()
+    r.clipboard_clear()
+    r.clipboard_append(msg)
+    r.update()
+    r.destroy()
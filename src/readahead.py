@@ -0,0 +1,76 @@
+'''
+Contains the read-ahead stage that overlaps file reads with decoding.
+'''
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from instrument import INSTRUMENTATION
+from utils import *
+
+
+class ReadAhead(object):
+
+    ''' Runs blocking reads ahead of their consumer on a thread pool.
+
+    Up to count reads are kept in flight, and fewer while their
+    announced sizes add up to more than max_bytes, so read-ahead stays
+    bounded on huge files. A single read is always allowed. A count of
+    0 reads synchronously. '''
+
+    def __init__(self, count=BODY_READ_AHEAD_COUNT, max_bytes=BODY_READ_AHEAD_MAX_BYTES,
+                 worker_count=BODY_READ_AHEAD_WORKER_COUNT):
+
+        self.count = count
+        self.max_bytes = max_bytes
+        self.worker_count = worker_count
+        self._executor = None
+
+    @property
+    def executor(self):
+        ''' Returns the reader threads, starting them on first use. '''
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.worker_count,
+                                                thread_name_prefix='read_ahead')
+        return self._executor
+
+    def map(self, function, items, size=None):
+        ''' Yields (item, function(item)) for every item, in order, calling
+        function ahead on the items that follow. Items are consumed
+        lazily; size(item) announces the bytes function will read. '''
+
+        if self.count <= 0:
+            for item in items:
+                yield item, function(item)
+            return
+
+        in_flight = deque()
+        in_flight_bytes = 0
+
+        for item in items:
+            item_bytes = 0 if size is None else size(item)
+
+            while in_flight and (len(in_flight) >= self.count or
+                                 in_flight_bytes + item_bytes > self.max_bytes):
+                done_item, future, done_bytes = in_flight.popleft()
+                in_flight_bytes -= done_bytes
+                with INSTRUMENTATION.stage('read_wait'):
+                    result = future.result()
+                yield done_item, result
+
+            in_flight.append((item, self.executor.submit(function, item), item_bytes))
+            in_flight_bytes += item_bytes
+
+        while in_flight:
+            done_item, future, _ = in_flight.popleft()
+            with INSTRUMENTATION.stage('read_wait'):
+                result = future.result()
+            yield done_item, result
+
+    def shutdown(self):
+        ''' Stops the reader threads. '''
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
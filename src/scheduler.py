@@ -0,0 +1,93 @@
+'''
+Contains a priority job scheduler with per-class cancellation.
+'''
+
+import heapq
+import itertools
+import time
+
+from texturecache import TextureFetchException
+from utils import *
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_VISIBLE = 1
+PRIORITY_PREFILL = 2
+
+
+class ScheduledJob(object):
+
+    ''' Scheduled job data container. '''
+
+    __slots__ = ['priority', 'function', 'args']
+
+    def __init__(self, priority, function, args):
+
+        self.priority = priority
+        self.function = function
+        self.args = args
+
+
+class JobScheduler(object):
+
+    ''' Runs queued jobs by priority class.
+
+    Lower priority values run first. Within a class jobs run in
+    submission order, or newest first when submitted so, which lets
+    the latest visible rows overtake rows scrolled past. cancel()
+    drops the queued jobs of some or all priority classes. '''
+
+    def __init__(self):
+
+        self._queue = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def submit(self, priority, function, *args, newest_first=False):
+        ''' Queues function(*args) in a priority class. '''
+
+        sequence = next(self._sequence)
+        order = -sequence if newest_first else sequence
+        job = ScheduledJob(priority, function, args)
+        heapq.heappush(self._queue, (priority, order, job))
+
+    def cancel(self, priorities=None):
+        ''' Cancels the queued jobs of the given priority classes,
+        or every queued job. Returns the number of jobs cancelled. '''
+
+        if priorities is None:
+            priorities = {item[0] for item in self._queue}
+        priorities = set(priorities)
+
+        queued = len(self._queue)
+        self._queue = [item for item in self._queue if item[0] not in priorities]
+        heapq.heapify(self._queue)
+        return queued - len(self._queue)
+
+    def run_next(self):
+        ''' Runs the next job. Returns False if none was queued. Errors
+        raised by the job are logged so the jobs after it still run. '''
+
+        if not self._queue:
+            return False
+
+        job = heapq.heappop(self._queue)[2]
+        try:
+            job.function(*job.args)
+        except (Exception, TextureFetchException):
+            ERROR('Scheduled job %s failed.' % getattr(job.function, '__name__', job.function),
+                  add_exception=True)
+        return True
+
+    def run_for(self, seconds):
+        ''' Runs jobs for about seconds, always running at least one.
+        Returns the number of jobs run. '''
+
+        deadline = time.perf_counter() + seconds
+        count = 0
+        while self.run_next():
+            count += 1
+            if time.perf_counter() >= deadline:
+                break
+        return count
@@ -0,0 +1,1144 @@
+'''
+This file contains classes for handling
+cache reading from the Second Life viewer
+texture cache.
+
+Nothing here imports Qt, so the cache can be scripted from batch jobs
+through iter_entries and iter_textures without a display or a
+QApplication. texturefetch adapts this module to Qt signals.
+'''
+
+
+import mmap
+import os
+import time
+
+import numpy as np
+
+from decodepool import CompletedJob, DecodePool, decode_texture_job
+from fastcache import FastCache
+from instrument import INSTRUMENTATION
+from j2c import *
+from lru import LRUCache
+from readahead import ReadAhead
+from utils import *
+
+HEADER_VERSION_BYTE_COUNT = 4
+HEADER_ADDRESS_SIZE_BYTE_COUNT = 4
+HEADER_ENCODER_VERSION_BYTE_COUNT = 32
+HEADER_ENTRY_COUNT_BYTE_COUNT = 4
+
+ENTRY_UUID_BYTE_COUNT = 16
+ENTRY_IMAGE_SIZE_BYTE_COUNT = 4
+ENTRY_BODY_SIZE_BYTE_COUNT = 4
+ENTRY_TIME_BYTE_COUNT = 4
+
+HEADER_DTYPE = np.dtype([('version', '<f4'),
+                         ('address_size', '<u4'),
+                         ('encoder_version', 'S32'),
+                         ('entry_count', '<u4')])
+
+ENTRY_DTYPE = np.dtype([('uuid', 'u1', ENTRY_UUID_BYTE_COUNT),
+                        ('image_size', '<i4'),
+                        ('body_size', '<i4'),
+                        ('time', '<u4')])
+
+TEXTURE_CACHE_BYTE_COUNT = 600
+
+CACHE_SUBDIRECTORY_NAMES = '0123456789abcdef'
+TEXTURE_BODY_EXTENSION = '.texture'
+
+
+
+class TextureFetchException(BaseException):
+    pass
+
+class TextureFetchThumbnail(object):
+
+    ''' Texture cache thumbnail data container. '''
+
+    __slots__ = ['entry', 'thumbnail']
+
+    def __init__(self, entry, thumbnail):
+
+        self.entry = entry
+        self.thumbnail = thumbnail
+
+    @property
+    def uuid(self):
+        return self.entry.uuid
+
+    @property
+    def time(self):
+        return self.entry.time
+
+
+class TextureFetchBitmap(object):
+
+    ''' Texture cache bitmap data container. '''
+
+    __slots__ = ['entry', 'bitmap']
+
+    def __init__(self, entry, bitmap):
+
+        self.entry = entry
+        self.bitmap = bitmap
+
+    @property
+    def uuid(self):
+        return self.entry.uuid
+
+    @property
+    def time(self):
+        return self.entry.time
+
+
+class TextureCacheUpdate(object):
+
+    ''' Entry table update data container. '''
+
+    __slots__ = ['entries', 'indices', 'removed', 'cache_file_contents']
+
+    def __init__(self, entries, indices, removed, cache_file_contents):
+
+        self.entries = entries
+        self.indices = indices
+        self.removed = removed
+        self.cache_file_contents = cache_file_contents
+
+
+class TextureCacheReader(object):
+
+    ''' Reads, decodes and caches texture cache items. '''
+
+    def __init__(self, fetcher, worker_count=None, thumbnail_store=None,
+                 cache_max_bytes=TEXTURE_CACHE_HEAD_MAX_BYTES,
+                 bitmap_cache_max_bytes=BITMAP_CACHE_MAX_BYTES):
+        self.fetcher = fetcher
+        self.local_texture_cache = TextureCache(cache_max_bytes, self.reload_texture_cache)
+        self.bitmap_cache = LRUCache(bitmap_cache_max_bytes, sizeof=lambda img: img.nbytes)
+        self.decode_pool = DecodePool(worker_count)
+        self.body_read_ahead = ReadAhead()
+        self.thumbnail_store = thumbnail_store
+        self.entry_snapshot = None
+        self.last_update = None
+        self.fast_cache = None
+        self._metadata = None
+        self.max_time = None
+
+    def set_fetcher(self, fetcher):
+        self.fetcher = fetcher
+        self.entry_snapshot = None
+        self.last_update = None
+        self.close_fast_cache()
+        self._metadata = None
+        self.bitmap_cache.clear()
+
+    def close_fast_cache(self):
+        if self.fast_cache is not None:
+            self.fast_cache.close()
+            self.fast_cache = None
+
+    def clear_local_cache(self):
+        self.local_texture_cache.clear()
+        self.bitmap_cache.clear()
+
+    def reload_texture_cache(self, uuid, entry_number):
+        # slots are reused when the viewer rewrites its entries
+        if self.entry_snapshot is not None and self.entry_snapshot.find(uuid) != entry_number:
+            return None
+        return self.fetcher.read_texture_cache(entry_number)
+
+    def update_entries(self, rebuild=True, max_time=None):
+        '''Loads the entry table and selects the entries to fetch.
+
+        Without rebuild, the entry table is diffed against the one from
+        the previous update: only added and changed entries are selected,
+        removed entries are reported and the previous time window is
+        reused unless max_time is given. '''
+
+        entries = self.fetcher.load_entry_table()
+        cache_file_contents = self.fetcher.load_cache_file_contents()
+        self.fetcher.body_index.refresh()
+        self.close_fast_cache()
+        self._metadata = None
+        removed = []
+
+        if rebuild or self.entry_snapshot is None:
+            self.max_time = max_time
+            indices = entries.select_window(max_time)
+        else:
+            if max_time is None:
+                max_time = self.max_time
+            added, changed, removed = entries.diff(self.entry_snapshot)
+            INFO('Refreshing texture cache entries. (ADDED: %i, CHANGED: %i, REMOVED: %i)'
+                 % (len(added), len(changed), len(removed)))
+            for uuid in removed:
+                self.local_texture_cache.discard_cache(uuid)
+                self.bitmap_cache.discard(uuid)
+            for i in changed:
+                self.bitmap_cache.discard(entries.uuids[i])
+            indices = entries.sort_newest_first(np.union1d(added, changed))
+            if max_time is not None:
+                indices = indices[entries.times[indices] >= time.time() - max_time]
+
+        self.entry_snapshot = entries.copy()
+        self.last_update = TextureCacheUpdate(entries, indices, removed, cache_file_contents)
+
+        return self.last_update
+
+    @property
+    def metadata(self):
+        ''' Returns the J2C header metadata of the last update's
+        entries, parsed on first use. '''
+
+        if self._metadata is None and self.last_update is not None:
+            update = self.last_update
+            self._metadata = self.fetcher.load_metadata(update.cache_file_contents, len(update.entries))
+        return self._metadata
+
+    def window_indices(self):
+        ''' Returns the indices of the entries in use within the time
+        window of the last update, newest first. '''
+
+        return self.entry_snapshot.select_window(self.max_time)
+
+    def select(self, indices):
+        ''' Returns an update selecting the given entry indices
+        of the last update's entry table. '''
+
+        update = self.last_update
+        indices = np.asarray(indices, dtype=np.intp)
+        indices = indices[(indices >= 0) & (indices < len(update.entries))]
+        return TextureCacheUpdate(update.entries, indices, [], update.cache_file_contents)
+
+    def select_lazily(self, indices):
+        ''' Returns an update selecting entry indices of the last update's
+        entry table that are consumed from the indices iterable as the
+        update is fetched, so more can be queued while it runs. '''
+
+        update = self.last_update
+        count = len(update.entries)
+        indices = (i for i in indices if 0 <= i < count)
+        return TextureCacheUpdate(update.entries, indices, [], update.cache_file_contents)
+
+    def iter_thumbnails(self, update):
+        '''Lazily yields (entry, thumbnail) for the entries selected by an
+        update, in completion order. Thumbnails are None where decoding
+        failed. '''
+
+        self.select_decoder()
+        pending = {}
+        stored = set()
+        jobs = self._thumbnail_jobs(update, pending, stored)
+
+        for uuid, img in self.decode_pool.decode(jobs):
+            entry = pending.pop(uuid)
+            if uuid in stored:
+                stored.discard(uuid)
+            elif self.thumbnail_store is not None:
+                with INSTRUMENTATION.stage('store_write'):
+                    self.thumbnail_store.put(entry, img)
+            yield entry, img
+
+    def select_decoder(self):
+        ''' Selects the decoder backend once, benchmarking it on a complete
+        codestream of the last update's entry table. '''
+
+        if self.decode_pool.decoder is None and self.last_update is not None:
+            update = self.last_update
+            sample = self.fetcher.load_benchmark_sample(update.cache_file_contents, update.entries)
+            self.decode_pool.select_decoder(sample, thumbnail=True)
+
+    def iter_fast_thumbnails(self, update):
+        '''Yields (entry, thumbnail) for the entries selected by an update
+        from the fast cache, without decoding. Thumbnails are None where
+        the fast cache holds no image. '''
+
+        if self.fast_cache is None:
+            self.fast_cache = self.fetcher.load_fast_cache()
+
+        entries = update.entries
+
+        for i in update.indices:
+            img = None if self.fast_cache is None else self.fast_cache.get(i)
+            yield entries[i], img
+
+    def _thumbnail_jobs(self, update, pending, stored):
+        ''' Yields (uuid, codestream) decode jobs, recording
+        the entry of each submitted job in pending.
+
+        Thumbnails found in the thumbnail store are passed through
+        the decode pool as completed jobs and recorded in stored.
+        Codestreams are assembled ahead while earlier jobs decode. '''
+
+        heads = self._thumbnail_heads(update, pending, stored)
+
+        for _, job in self.body_read_ahead.map(self._assemble_job, heads, self._job_body_size):
+            yield job
+
+    def _thumbnail_heads(self, update, pending, stored):
+        ''' Yields the (entry, cache) heads of the thumbnail decode
+        jobs, or their completed jobs. '''
+
+        entries = update.entries
+
+        for i in update.indices:
+
+            entry = entries[i]
+            uuid = entry.uuid
+            if uuid in pending:
+                continue
+            with INSTRUMENTATION.stage('head_read'):
+                cache = bytes(self.fetcher.load_texture_cache(update.cache_file_contents, i))
+            self.local_texture_cache.add_cache(uuid, cache, i)
+
+            pending[uuid] = entry
+
+            if self.thumbnail_store is not None:
+                with INSTRUMENTATION.stage('store_lookup'):
+                    img = self.thumbnail_store.get(entry)
+                if img is not None:
+                    stored.add(uuid)
+                    yield CompletedJob((uuid, img, None))
+                    continue
+
+            yield entry, cache
+
+    def _job_body_size(self, head):
+        if isinstance(head, CompletedJob):
+            return 0
+        return self.fetcher.body_index.size(head[0].uuid) or 0
+
+    def _assemble_job(self, head):
+        if isinstance(head, CompletedJob):
+            return head
+        entry, cache = head
+        return entry.uuid, self.fetcher.assemble_codestream(entry.uuid, cache, entry.image_size)
+
+    def fetch_bitmap(self, uuid, reduce=0):
+        '''Fetches a complete texture cache bitmap as an ndarray,
+        reduced reduce times.
+
+        Decoded full resolution bitmaps are kept in a byte-budgeted LRU
+        cache shared by previews and saves, so repeated requests skip
+        the decode. '''
+
+        if reduce:
+            return self.decode_bitmap(uuid, reduce)
+
+        img = self.bitmap_cache.get(uuid)
+        if img is None:
+            img = self.decode_bitmap(uuid)
+            if img is not None:
+                self.bitmap_cache.put(uuid, img)
+
+        return img
+
+    def preview_reduce_levels(self, uuid, step=PREVIEW_REDUCE_STEP):
+        '''Returns the reduce levels of the passes of a progressive
+        preview, from the thumbnail level down to full resolution in
+        steps of step levels. Only the full resolution pass is left
+        for cached bitmaps and codestreams without a readable header. '''
+
+        if uuid in self.bitmap_cache:
+            return [0]
+
+        header = read_j2c_header(self.load_bitmap_cache(uuid))
+        if header is None:
+            return [0]
+
+        reduce, _ = thumbnail_decode_parameters(int(header['width']), int(header['height']),
+                                                int(header['levels']), int(header['layers']))
+        return list(range(reduce, 0, -step)) + [0]
+
+    def decode_bitmap(self, uuid, reduce=0):
+        '''Decodes a complete texture cache bitmap to an ndarray,
+        reduced reduce times. '''
+
+        cache = self.load_bitmap_cache(uuid)
+
+        index = None if self.entry_snapshot is None else self.entry_snapshot.find(uuid)
+        image_size = None if index is None else self.entry_snapshot[index].image_size
+        self.fetcher.body_index.refresh(uuid[0])
+        codestream = self.fetcher.assemble_codestream(uuid, cache, image_size)
+        self.select_decoder()
+
+        with INSTRUMENTATION.stage('bitmap_decode'):
+            return decode_j2c(uuid, codestream, reduce=reduce)
+
+    def load_bitmap_cache(self, uuid):
+        '''Returns the texture cache of a UUID, loading it from the
+        entry table last listed if it was not fetched yet. '''
+
+        cache = None
+        if uuid in self.local_texture_cache.uuids:
+            cache = self.local_texture_cache.get_cache(uuid)
+
+        if cache is None:
+            # entries listed but not fetched yet, or moved since, are looked up in the entry table
+            index = None if self.entry_snapshot is None else self.entry_snapshot.find(uuid)
+            if index is None:
+                raise TextureFetchException('UUID "%s" cache not found in local texture cache.' % uuid)
+            cache = self.fetcher.read_texture_cache(index)
+            self.local_texture_cache.add_cache(uuid, cache, index)
+
+        return cache
+
+
+class TextureCacheFetcher(object):
+
+    '''Handles texture fetch I/O.
+
+    File contents are handed out as memoryviews. In memory-mapped mode
+    they are backed by read-only mappings of the cache files so slices
+    are zero-copy and only the pages actually read become resident.'''
+
+    def __init__(self, entries_file_path, memory_mapped=False):
+        self.set_entries_path(entries_file_path)
+        self.memory_mapped = memory_mapped
+        self.body_index = TextureBodyIndex(self.cache_directory)
+        self.size_mismatches = {}
+        self._mappings = {}
+        self._retired_mappings = []
+        self._fast_cache = None
+
+    @property
+    def cache(self):
+        return self.local_texture_cache
+
+    def set_entries_path(self, entries_file_path):
+        '''Sets the entries file path.'''
+
+        if not 'texture.entries' in entries_file_path:
+            ERROR('Invalid entries file path "%s"' % entries_file_path)
+            raise TextureFetchException('Invalid entries file path "%s"' % entries_file_path)
+
+        self.entries_path = entries_file_path
+
+    def load_entry_file_contents(self):
+        ''' Loads the total entry file contents. '''
+
+        return self.load_file_contents(self.entries_path)
+
+    def load_cache_file_contents(self):
+        ''' Loads the total cache file contents. '''
+
+        return self.load_file_contents(self.cache_path)
+
+    def load_file_contents(self, path):
+        ''' Loads file contents as a memoryview, mapping
+        the file instead of reading it in memory-mapped mode.
+
+        One mapping is kept per file; the one a load replaces is closed
+        as soon as no view of it is left. '''
+
+        with INSTRUMENTATION.stage('file_load'), open(path, 'rb') as contents_file:
+            if not self.memory_mapped:
+                return memoryview(contents_file.read())
+
+            # empty files cannot be mapped
+            if os.fstat(contents_file.fileno()).st_size == 0:
+                mapping = None
+            else:
+                mapping = mmap.mmap(contents_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.retire_mapping(path)
+        if mapping is None:
+            return memoryview(b'')
+        self._mappings[path] = mapping
+        return memoryview(mapping)
+
+    def retire_mapping(self, path):
+        ''' Closes the mapping of a file, or leaves it to be closed by a
+        later load or close() while views of it are still in use. '''
+
+        mapping = self._mappings.pop(path, None)
+        if mapping is not None:
+            self._retired_mappings.append(mapping)
+        self._close_retired_mappings()
+
+    def _close_retired_mappings(self):
+        open_mappings = []
+        for mapping in self._retired_mappings:
+            try:
+                mapping.close()
+            except BufferError:
+                open_mappings.append(mapping)
+        self._retired_mappings = open_mappings
+
+    def close(self):
+        ''' Closes the file mappings and the fast cache. Mappings still
+        viewed are released once their views are garbage collected. '''
+
+        self._retired_mappings.extend(self._mappings.values())
+        self._mappings = {}
+        self._close_retired_mappings()
+        self.close_fast_cache()
+
+    @property
+    def cache_directory(self):
+        ''' Returns absolute path to cache directory. '''
+
+        directory = os.path.dirname(self.entries_path)
+        return os.path.abspath(directory)
+
+    @property
+    def cache_path(self):
+        ''' Returns the path to the cache file. '''
+
+        directory = self.cache_directory
+        return os.path.join(directory, 'texture.cache')
+
+    @property
+    def fast_cache_path(self):
+        ''' Returns the path to the fast cache file. '''
+
+        directory = self.cache_directory
+        return os.path.join(directory, 'FastCache.cache')
+
+    def load_fast_cache(self):
+        ''' Loads the fast cache, or returns None if there is none.
+        The fast cache loaded before is closed. '''
+
+        self.close_fast_cache()
+
+        if not os.path.exists(self.fast_cache_path):
+            INFO('Did not find fast cache "%s"' % self.fast_cache_path)
+            return None
+
+        self._fast_cache = FastCache(self.fast_cache_path, self.memory_mapped)
+        return self._fast_cache
+
+    def close_fast_cache(self):
+        ''' Closes the fast cache loaded last, if any. '''
+
+        if self._fast_cache is not None:
+            self._fast_cache.close()
+            self._fast_cache = None
+
+
+    @property
+    def header_byte_count(self):
+        ''' Calculates total header byte count. '''
+
+        total_bytes = (HEADER_ADDRESS_SIZE_BYTE_COUNT +
+                       HEADER_ENCODER_VERSION_BYTE_COUNT +
+                       HEADER_ENTRY_COUNT_BYTE_COUNT +
+                       HEADER_VERSION_BYTE_COUNT)
+
+        return total_bytes
+
+
+    def load_header(self, entries_file_contents):
+        '''Loads the texture cache header.'''
+
+        buffer = entries_file_contents[:self.header_byte_count]
+        if len(buffer) < self.header_byte_count:
+            ERROR('Could not unpack texture cache header.')
+            raise TextureFetchException('Failed to unpack texture cache header.')
+
+        with INSTRUMENTATION.stage('header_parse'):
+            unpacked = np.frombuffer(buffer, dtype=HEADER_DTYPE, count=1)[0]
+            version = '%0.2f' % unpacked['version']
+            address_size = int(unpacked['address_size'])
+            encoder_version = unpacked['encoder_version'].decode('utf-8').replace('\x00', '')
+            entry_count = int(unpacked['entry_count'])
+
+        INFO('Read header from texture cache.'
+             ' (VERSION: %s, ADDRESS_SIZE: %i, ENCODER_VERSION: %s, ENTRY_COUNT %i)'
+             % (version, address_size, encoder_version, entry_count))
+
+        return TextureCacheHeader(version, address_size, encoder_version, entry_count)
+
+    @property
+    def entry_byte_count(self):
+        ''' Calculates total entry byte count. '''
+
+        total_bytes = (ENTRY_BODY_SIZE_BYTE_COUNT +
+                       ENTRY_IMAGE_SIZE_BYTE_COUNT +
+                       ENTRY_TIME_BYTE_COUNT +
+                       ENTRY_UUID_BYTE_COUNT)
+
+        return total_bytes
+
+
+    def load_entries(self, entries_file_contents, entry_count):
+        '''Loads the texture cache entries manifest.'''
+
+        with INSTRUMENTATION.stage('entry_parse'):
+            available = max(len(entries_file_contents) - self.header_byte_count, 0) // self.entry_byte_count
+            records = np.frombuffer(entries_file_contents, dtype=ENTRY_DTYPE,
+                                    count=min(entry_count, available),
+                                    offset=self.header_byte_count)
+            entries = TextureCacheEntries(records)
+
+        INFO('Read %i entries from texture cache.' % len(entries))
+
+        if len(entries) != entry_count:
+
+            WARN('Number of read entries (%i) does not match expected count (%i)'
+                 % (len(entries), entry_count))
+
+        return entries
+
+    def load_entry_table(self):
+        ''' Loads the entry file and parses its header and entries. '''
+
+        entry_file_contents = self.load_entry_file_contents()
+        header = self.load_header(entry_file_contents)
+        return self.load_entries(entry_file_contents, header.entry_count)
+
+    def load_metadata(self, cache_file_contents, entry_count):
+        ''' Parses the J2C main headers of the texture cache heads. '''
+
+        with INSTRUMENTATION.stage('metadata_parse'):
+            available = len(cache_file_contents) // TEXTURE_CACHE_BYTE_COUNT
+            records = parse_j2c_heads(cache_file_contents, min(entry_count, available),
+                                      TEXTURE_CACHE_BYTE_COUNT)
+
+        INFO('Read %i J2C headers from texture cache.' % records['valid'].sum())
+
+        return TextureCacheMetadata(records)
+
+    def load_texture_cache(self, cache_file_contents, entry_number):
+        ''' Loads texture cache from cache file contents given entry number.'''
+
+        offset = TEXTURE_CACHE_BYTE_COUNT*entry_number
+        return cache_file_contents[offset:offset + TEXTURE_CACHE_BYTE_COUNT]
+
+    def load_codestream(self, cache_file_contents, entry_number, uuid, image_size=None):
+        ''' Reassembles an entry's J2C codestream from its texture cache and body. '''
+
+        offset = TEXTURE_CACHE_BYTE_COUNT*entry_number
+        with memoryview(cache_file_contents)[offset:offset + TEXTURE_CACHE_BYTE_COUNT] as cache:
+            return self.assemble_codestream(uuid, cache, image_size)
+
+    def load_benchmark_sample(self, cache_file_contents, entries, limit=64):
+        ''' Returns the codestream of the newest of the first limit
+        entries in use whose body on disk is as large as listed, or
+        None. Partial downloads are skipped so a backend failing on
+        one is not ruled out. '''
+
+        for i in entries.select_indices()[:limit]:
+            entry = entries[i]
+            body_size = entry.image_size - TEXTURE_CACHE_BYTE_COUNT
+            if body_size > 0 and self.body_index.size(entry.uuid) == body_size:
+                return self.load_codestream(cache_file_contents, i, entry.uuid, entry.image_size)
+        return None
+
+    def assemble_codestream(self, uuid, cache, image_size=None):
+        ''' Reassembles a J2C codestream from its texture cache and body
+        into a single bytearray, reading the body file in place.
+
+        image_size is the codestream size listed in the entry table.
+        Texture caches of codestreams without a body are cut to it, and
+        codestreams of another size are recorded in size_mismatches. '''
+
+        body_size = self.body_index.size(uuid) or 0
+        cache_size = len(cache)
+        if not body_size and image_size is not None and 0 < image_size < cache_size:
+            cache_size = image_size
+
+        codestream = bytearray(cache_size + body_size)
+        codestream[:cache_size] = cache[:cache_size]
+
+        if body_size:
+            with INSTRUMENTATION.stage('body_read'):
+                try:
+                    with open(self.body_index.path(uuid), 'rb') as body_file, \
+                            memoryview(codestream)[cache_size:] as body:
+                        read_size = body_file.readinto(body)
+                except OSError:
+                    INFO('Could not read texture body for "%s"' % uuid)
+                    read_size = 0
+            if read_size < body_size:
+                del codestream[cache_size + read_size:]
+
+        if image_size is not None and len(codestream) != image_size:
+            self.size_mismatches[uuid] = len(codestream)
+        else:
+            self.size_mismatches.pop(uuid, None)
+
+        return codestream
+
+    def read_texture_cache(self, entry_number):
+        ''' Reads a single entry's texture cache straight from the cache file. '''
+
+        with INSTRUMENTATION.stage('head_reload'), open(self.cache_path, 'rb') as cache_file:
+            cache_file.seek(TEXTURE_CACHE_BYTE_COUNT*entry_number)
+            return cache_file.read(TEXTURE_CACHE_BYTE_COUNT)
+
+    def load_texture_body(self, uuid, refresh=False):
+
+        ''' Returns the contents of a texture's body file, or None if it has
+        none. Presence is looked up in the body index, which is refreshed
+        with every entry table load or, with refresh, for this UUID. '''
+
+        if refresh:
+            self.body_index.refresh(uuid[0])
+
+        if self.body_index.size(uuid) is None:
+            return None
+
+        with INSTRUMENTATION.stage('body_read'):
+            try:
+                with open(self.body_index.path(uuid), 'rb') as body_file:
+                    return body_file.read()
+            except OSError:
+                INFO('Could not read texture body for "%s"' % uuid)
+                return None
+
+
+class TextureBodyIndex(object):
+
+    ''' Index of the texture body files of a cache directory.
+
+    Each subdirectory is listed with a single os.scandir and relisted
+    only when its modification time changes, so presence and size
+    lookups need no per-file stat. Subdirectories modified within
+    MTIME_SETTLE_SECONDS of being listed are listed again on the next
+    refresh, in case of coarse file system timestamps. '''
+
+    MTIME_SETTLE_SECONDS = 2.0
+
+    def __init__(self, cache_directory):
+
+        self.cache_directory = cache_directory
+        self._sizes = {}
+        self._mtimes = {}
+
+    def path(self, uuid):
+        return os.path.join(self.cache_directory, uuid[0], uuid + TEXTURE_BODY_EXTENSION)
+
+    def size(self, uuid):
+        ''' Returns the body file size of a UUID, or None if it has none. '''
+
+        if uuid[0] not in self._sizes:
+            self.refresh(uuid[0])
+        return self._sizes[uuid[0]].get(uuid)
+
+    def refresh(self, names=CACHE_SUBDIRECTORY_NAMES):
+        ''' Relists the named subdirectories that changed. '''
+
+        with INSTRUMENTATION.stage('body_scan'):
+            for name in names:
+                directory = os.path.join(self.cache_directory, name)
+                try:
+                    mtime = os.stat(directory).st_mtime
+                except OSError:
+                    self._sizes[name] = {}
+                    self._mtimes.pop(name, None)
+                    continue
+
+                if self._mtimes.get(name) == mtime:
+                    continue
+
+                self._sizes[name] = self.scan(directory)
+                settled = time.time() - mtime >= self.MTIME_SETTLE_SECONDS
+                self._mtimes[name] = mtime if settled else None
+
+    def scan(self, directory):
+        ''' Lists the body files of a subdirectory as a {uuid: size} dict. '''
+
+        sizes = {}
+        extension_length = len(TEXTURE_BODY_EXTENSION)
+        with os.scandir(directory) as scanned:
+            for entry in scanned:
+                if entry.name.endswith(TEXTURE_BODY_EXTENSION):
+                    try:
+                        sizes[entry.name[:-extension_length]] = entry.stat().st_size
+                    except OSError:
+                        pass
+        return sizes
+
+
+class TextureCache(object):
+    
+    ''' Container/mapper for UUID and cache contents.
+
+    Cache contents are held in a byte-budgeted LRU cache. The entry index
+    of every UUID is remembered so evicted contents can be reloaded from
+    texture.cache through loader(uuid, entry_number) on a miss. The
+    loader returns None when the entry no longer holds the UUID, and the
+    entry index is then forgotten. '''
+    
+    def __init__(self, max_bytes=TEXTURE_CACHE_HEAD_MAX_BYTES, loader=None):
+        self._indices = {}
+        self._cache = LRUCache(max_bytes)
+        self.loader = loader
+
+    def __len__(self):
+        return len(self._indices)
+
+    @property
+    def uuids(self):
+        return self._indices.keys()
+
+    @property
+    def statistics(self):
+        ''' Returns the hit, miss and eviction counters. '''
+
+        return self._cache.statistics
+
+    def add_cache(self, uuid, cache, index=None):
+        ''' Add cache contents for UUID at entry index '''
+        
+        self._indices[uuid] = index
+        self._cache.put(uuid, cache)
+
+    def get_cache(self, uuid):
+        ''' Get cache contents for UUID, reloading them if evicted '''
+        
+        cache = self._cache.get(uuid)
+        if cache is not None:
+            return cache
+
+        try:
+            index = self._indices[uuid]
+        except KeyError:
+            WARN('Did not find UUID "%s" in local cache contents.' % uuid)
+            return None
+
+        if index is None or self.loader is None:
+            WARN('Cannot reload evicted cache contents for UUID "%s".' % uuid)
+            return None
+
+        cache = self.loader(uuid, index)
+        if cache is None:
+            WARN('Entry %i no longer holds UUID "%s".' % (index, uuid))
+            del self._indices[uuid]
+            return None
+
+        self._cache.put(uuid, cache)
+        return cache
+
+    def delete_cache(self, uuid):
+        ''' Delete cache contents for UUID '''
+        
+        self._indices.pop(uuid)
+        self._cache.discard(uuid)
+
+    def discard_cache(self, uuid):
+        ''' Delete cache contents for UUID if present '''
+
+        self._indices.pop(uuid, None)
+        self._cache.discard(uuid)
+
+    def clear(self):
+        ''' Clear cache contents '''
+        
+        self._indices = {}
+        self._cache.clear()
+
+
+
+class TextureCacheHeader(object):
+
+    ''' Cache header data container. '''
+
+    def __init__(self, version, address_size,
+                 encoder_version, entry_count):
+
+        self.version = version
+        self.address_size = address_size
+        self.encoder_version = encoder_version
+        self.entry_count = entry_count
+
+
+class TextureCacheEntries(object):
+
+    ''' Cache entry table backed by a Numpy structured array. '''
+
+    def __init__(self, records):
+
+        self.records = records
+        self._uuids = None
+        self._key_order = None
+        self._sorted_keys = None
+        self._time_order = None
+        self._sorted_times = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        record = self.records[index]
+        return TextureCacheEntry(self.uuids[index],
+                                 int(record['body_size']),
+                                 int(record['image_size']),
+                                 int(record['time']),
+                                 int(index))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def uuids(self):
+        ''' Returns the entry UUID strings, formatted in bulk on first use. '''
+
+        if self._uuids is None:
+            self._uuids = format_uuids_from_u8_array(self.records['uuid'])
+        return self._uuids
+
+    def format_uuid(self, index):
+        ''' Returns the UUID string of a single entry. '''
+
+        if self._uuids is not None:
+            return self._uuids[index]
+        return format_uuid_from_u8(self.records['uuid'][index])
+
+    def find(self, uuid):
+        ''' Returns the index of the entry in use with the given UUID
+        string, or None. '''
+
+        if self._key_order is None:
+            keys = self.uuid_keys
+            self._key_order = np.argsort(keys)
+            self._sorted_keys = keys[self._key_order]
+
+        key = np.frombuffer(bytes.fromhex(uuid.replace('-', '')), dtype='S%i' % ENTRY_UUID_BYTE_COUNT)[0]
+        position = np.searchsorted(self._sorted_keys, key)
+        while position < len(self._sorted_keys) and self._sorted_keys[position] == key:
+            index = int(self._key_order[position])
+            if self.records['image_size'][index] >= 0:
+                return index
+            position += 1
+        return None
+
+    @property
+    def times(self):
+        return self.records['time']
+
+    @property
+    def uuid_keys(self):
+        ''' Returns the raw UUIDs as an array of 16-byte strings. '''
+
+        return np.ascontiguousarray(self.records['uuid']).view('S%i' % ENTRY_UUID_BYTE_COUNT).ravel()
+
+    @property
+    def valid_indices(self):
+        ''' Returns the indices of entries in use. The viewer marks
+        freed entry slots with a negative image size. '''
+
+        return np.flatnonzero(self.records['image_size'] >= 0)
+
+    @property
+    def time_order(self):
+        ''' Returns the indices of entries in use sorted by time,
+        oldest first. Built once per entry table. '''
+
+        if self._time_order is None:
+            indices = self.valid_indices
+            order = np.argsort(self.times[indices], kind='stable')
+            self._time_order = indices[order]
+            self._sorted_times = self.times[self._time_order]
+        return self._time_order
+
+    def select_indices(self, since=None, until=None):
+        ''' Returns the indices of entries in use written between the Unix
+        times since and until (both inclusive, either open), newest first.
+
+        The range is resolved by binary search over the time order. '''
+
+        order = self.time_order
+        start = 0 if since is None else np.searchsorted(self._sorted_times, since, 'left')
+        stop = len(order) if until is None else np.searchsorted(self._sorted_times, until, 'right')
+        return order[start:stop][::-1]
+
+    def select_window(self, max_time=None):
+        ''' Returns the indices of entries in use written within
+        the last max_time seconds, newest first. '''
+
+        if max_time is None:
+            return self.select_indices()
+        return self.select_indices(since=time.time() - max_time)
+
+    def sort_newest_first(self, indices):
+        ''' Returns indices ordered by entry time, newest first. '''
+
+        indices = np.asarray(indices, dtype=np.intp)
+        return indices[np.argsort(self.times[indices], kind='stable')[::-1]]
+
+    def copy(self):
+        ''' Returns a copy that does not reference the file contents. '''
+
+        copied = TextureCacheEntries(self.records.copy())
+        copied._uuids = self._uuids
+        copied._time_order = self._time_order
+        copied._sorted_times = self._sorted_times
+        return copied
+
+    def diff(self, previous):
+        ''' Compares the valid entries with a previous entry table.
+
+        Returns the indices of added entries, the indices of entries whose
+        time or sizes changed, and the UUIDs of removed entries. '''
+
+        indices = self.valid_indices
+        previous_indices = previous.valid_indices
+        keys = self.uuid_keys[indices]
+        previous_keys = previous.uuid_keys[previous_indices]
+
+        if len(previous_keys) == 0:
+            return indices, indices[:0], []
+
+        order = np.argsort(previous_keys)
+        positions = np.minimum(np.searchsorted(previous_keys[order], keys), len(order) - 1)
+        matches = previous_indices[order[positions]]
+        found = previous.uuid_keys[matches] == keys
+
+        differs = np.zeros(len(indices), dtype=bool)
+        for field in ('time', 'image_size', 'body_size'):
+            differs |= self.records[field][indices] != previous.records[field][matches]
+
+        added = indices[~found]
+        changed = indices[found & differs]
+        removed = [previous.uuids[i] for i in previous_indices[~np.isin(previous_keys, keys)]]
+
+        return added, changed, removed
+
+
+class TextureCacheMetadata(object):
+
+    ''' J2C header metadata table, indexed like the entry table.
+
+    Entries whose head holds no valid SIZ marker, or that lie past
+    the end of texture.cache, are reported invalid. '''
+
+    def __init__(self, records):
+
+        self.records = records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        return self.records[index]
+
+    @property
+    def valid(self):
+        return self.records['valid']
+
+    @property
+    def width(self):
+        return self.records['width']
+
+    @property
+    def height(self):
+        return self.records['height']
+
+    @property
+    def components(self):
+        return self.records['components']
+
+    @property
+    def has_alpha(self):
+        ''' Returns a mask of textures with an alpha channel. '''
+
+        return self.valid & ((self.components == 2) | (self.components == 4))
+
+    def select(self, indices, min_width=0, min_height=0, alpha=None):
+        ''' Returns the indices with valid metadata at least min_width by
+        min_height in size, limited to textures with (or without) alpha
+        when alpha is given. Order is kept. '''
+
+        indices = np.asarray(indices, dtype=np.intp)
+        indices = indices[indices < len(self.records)]
+        mask = self.valid[indices]
+        mask &= (self.width[indices] >= min_width) & (self.height[indices] >= min_height)
+        if alpha is not None:
+            mask &= self.has_alpha[indices] == alpha
+        return indices[mask]
+
+    def sort_by_area(self, indices, descending=True):
+        ''' Returns indices ordered by texture area. '''
+
+        indices = np.asarray(indices, dtype=np.intp)
+        area = self.width[indices].astype(np.int64) * self.height[indices]
+        order = np.argsort(-area if descending else area, kind='stable')
+        return indices[order]
+
+
+class TextureCacheEntry(object):
+
+    ''' Cache entry data container. '''
+
+    __slots__ = ['uuid', 'body_size', 'image_size', 'time', 'index']
+
+    def __init__(self, uuid, body_size, image_size, time, index=None):
+
+        self.uuid = uuid
+        self.body_size = body_size
+        self.image_size = image_size
+        self.time = time
+        self.index = index
+
+
+def iter_entries(entries_path, since=None, memory_mapped=True):
+    ''' Lazily yields the entries in use of a texture cache, newest first,
+    limited to entries written at or after the Unix time since when given. '''
+
+    fetcher = TextureCacheFetcher(entries_path, memory_mapped)
+    try:
+        entries = fetcher.load_entry_table().copy()
+    finally:
+        fetcher.close()
+
+    for i in entries.select_indices(since):
+        yield entries[i]
+
+
+def iter_textures(entries_path, since=None, decode=False, thumbnail=False,
+                  worker_count=1, memory_mapped=True):
+    ''' Lazily yields (entry, texture) for the entries in use of a texture
+    cache, limited to entries written at or after the Unix time since.
+
+    Textures are raw J2C codestreams, or ndarrays (None where decoding
+    failed) when decode is set. Decoding runs on worker_count processes
+    and yields in completion order; otherwise entries are yielded newest
+    first. Codestreams are read ahead of their use, and only one per
+    pending decode or read is held in memory. '''
+
+    fetcher = TextureCacheFetcher(entries_path, memory_mapped)
+    read_ahead = ReadAhead()
+    decode_pool = None
+    cache_file_contents = None
+
+    try:
+        entries = fetcher.load_entry_table().copy()
+        cache_file_contents = fetcher.load_cache_file_contents()
+        fetcher.body_index.refresh()
+        indices = entries.select_indices(since)
+
+        def load_codestream(i):
+            return fetcher.load_codestream(cache_file_contents, i, entries.uuids[i],
+                                           int(entries.records['image_size'][i]))
+
+        def body_size(i):
+            return fetcher.body_index.size(entries.uuids[i]) or 0
+
+        codestreams = read_ahead.map(load_codestream, indices, body_size)
+
+        if not decode:
+            for i, codestream in codestreams:
+                yield entries[i], codestream
+            return
+
+        def jobs():
+            for i, codestream in codestreams:
+                yield int(i), entries.uuids[i], codestream, thumbnail
+
+        decode_pool = DecodePool(worker_count)
+        decode_pool.select_decoder(fetcher.load_benchmark_sample(cache_file_contents, entries),
+                                   thumbnail)
+        for i, img in decode_pool.map_unordered(decode_texture_job, jobs()):
+            yield entries[i], img
+    finally:
+        if decode_pool is not None:
+            decode_pool.shutdown()
+        read_ahead.shutdown()
+        if cache_file_contents is not None:
+            cache_file_contents.release()
+        fetcher.close()
@@ -1,362 +1,298 @@
-
 '''
-This file contains classes for handling
-cache reading from the Second Life viewer
+This file contains the Qt service for fetching
+texture cache items from the Second Life viewer
 texture cache.
+
+Cache reading and decoding live in texturecache, which
+does not depend on Qt; this module converts its results
+to pixmaps and delivers them through signals.
 '''
 
 
-import os
-import struct
-import sys
-import weakref
 import time
-from collections import namedtuple
-from io import BytesIO
-from traceback import format_exc
+from collections import deque
 
-import glymur
-import numpy as np
 from PyQt5 import QtCore
 
-from utils import *
+from instrument import INSTRUMENTATION
+from qtutils import *
+from texturecache import *
 
-HEADER_VERSION_BYTE_COUNT = 4
-HEADER_ADDRESS_SIZE_BYTE_COUNT = 4
-HEADER_ENCODER_VERSION_BYTE_COUNT = 32
-HEADER_ENTRY_COUNT_BYTE_COUNT = 4
-HEADER_STRUCT_FORMAT = 'fI32sI'
 
-ENTRY_UUID_BYTE_COUNT = 16
-ENTRY_IMAGE_SIZE_BYTE_COUNT = 4
-ENTRY_BODY_SIZE_BYTE_COUNT = 4
-ENTRY_TIME_BYTE_COUNT = 4
-ENTRY_STRUCT_FORMAT = '16BiiI'
+class TextureFetchEntries(object):
 
-TEXTURE_CACHE_BYTE_COUNT = 600
+    ''' Texture cache entry table listing data container.
 
+    Holds the entry table, the indices of the entries to list and the
+    UUIDs whose thumbnails are stale, or None when all of them are. '''
 
+    __slots__ = ['entries', 'indices', 'invalidated']
 
-class TextureFetchException(BaseException):
-    pass
+    def __init__(self, entries, indices, invalidated):
 
-class TextureFetchThumbnail(object):
+        self.entries = entries
+        self.indices = indices
+        self.invalidated = invalidated
 
-    ''' Texture cache thumbnail data container. '''
 
-    __slots__ = ['entry', 'thumbnail']
+class ThumbnailBatcher(object):
 
-    def __init__(self, entry, thumbnail):
+    ''' Collects thumbnails into batches for delivery.
 
-        self.entry = entry
-        self.thumbnail = thumbnail
+    A batch is delivered once it holds max_count thumbnails or once
+    max_interval seconds have passed since the previous delivery, so
+    batches grow while decoding is fast and stay small while it is
+    slow. '''
 
-    @property
-    def uuid(self):
-        return self.entry.uuid
+    def __init__(self, deliver, max_count=THUMBNAIL_BATCH_MAX_COUNT,
+                 max_interval=THUMBNAIL_BATCH_MAX_INTERVAL):
 
-    @property
-    def time(self):
-        return self.entry.time
+        self.deliver = deliver
+        self.max_count = max_count
+        self.max_interval = max_interval
+        self.batch = []
+        self.last_delivery_time = time.perf_counter()
 
+    def add(self, thumbnail):
+        self.batch.append(thumbnail)
+        if (len(self.batch) >= self.max_count or
+                time.perf_counter() - self.last_delivery_time >= self.max_interval):
+            self.flush()
 
-class TextureFetchBitmap(object):
+    def flush(self):
+        ''' Delivers the pending batch, if any. '''
 
-    ''' Texture cache bitmap data container. '''
+        self.last_delivery_time = time.perf_counter()
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        self.deliver(batch)
 
-    __slots__ = ['entry', 'bitmap']
+    def discard(self):
+        ''' Drops the pending batch without delivering it. '''
 
-    def __init__(self, entry, bitmap):
+        self.batch = []
 
-        self.entry = entry
-        self.bitmap = bitmap
 
-    @property
-    def uuid(self):
-        return self.entry.uuid
-
-    @property
-    def time(self):
-        return self.entry.time
+class ThumbnailStream(object):
 
+    ''' Fetches the thumbnails of queued entry indices one at a time.
 
-class TextureCacheFetchService(QtCore.QObject):
+    fetch(indices) must return a thumbnail iterator consuming indices
+    lazily. While indices keep being queued, one iterator stays open,
+    so the decode pool is not drained between requests and callers can
+    run other work between steps. The most recently queued indices are
+    fetched first. Thumbnails are delivered in batches through deliver,
+    or dropped when it is None. '''
 
-    ''' Handles fetching of texture cache items.'''
+    def __init__(self, fetch, deliver=None, batch_max_count=THUMBNAIL_BATCH_MAX_COUNT,
+                 batch_max_interval=THUMBNAIL_BATCH_MAX_INTERVAL):
 
-    thumbnail_available = QtCore.pyqtSignal(TextureFetchThumbnail)
-    bitmap_available = QtCore.pyqtSignal(TextureFetchBitmap)
+        self.fetch = fetch
+        self.batcher = None
+        if deliver is not None:
+            self.batcher = ThumbnailBatcher(deliver, batch_max_count, batch_max_interval)
+        self.pending = deque()
+        self.thumbnails = None
 
-    def __init__(self, fetcher, parent=None):
-        QtCore.QObject.__init__(self, parent)
-        self.fetcher = fetcher
-        self.local_texture_cache = TextureCache()
+    def add(self, indices):
+        ''' Queues entry indices ahead of those already queued. '''
 
-    def set_fetcher(self, fetcher):
-        self.fetcher = fetcher
+        self.pending.extendleft(reversed(list(indices)))
 
-    def clear_local_cache(self):
-        self.local_texture_cache.clear()
-
-    def fetch_thumbnails(self, rebuild=True, max_time=None):
-        '''Fetches texture cache thumbnails and UUID.'''
-
-        entry_file_contents = self.fetcher.load_entry_file_contents()
-        cache_file_contents = self.fetcher.load_cache_file_contents()
-        header = self.fetcher.load_header(entry_file_contents)
-        entries = self.fetcher.load_entries(entry_file_contents, header.entry_count)
-
-        current_time = time.time()
-
-        should_seek = not rebuild
-            
-        for i, entry in enumerate(entries):
-            
-            if max_time is not None:
-                if current_time - entry.time > max_time:
-                    continue
-            
-            uuid = entry.uuid
-            if not rebuild:
-                if uuid in self.local_texture_cache.uuids:
-                    continue
-            cache = self.fetcher.load_texture_cache(cache_file_contents, i, noseek=should_seek)
-            body = self.fetcher.load_texture_body(uuid)
-
-            if body is None:
-                thumbnail = convert_j2c_to_qpixmap(uuid, cache, thumbnail=True)
-            else:
-                thumbnail = convert_j2c_to_qpixmap(uuid, cache + body, thumbnail=True)
-
-            self.local_texture_cache.add_cache(entry.uuid, cache)
-            new_thumbnail_item = TextureFetchThumbnail(entry, thumbnail)
-            self.thumbnail_available.emit(new_thumbnail_item)
-            
-
-    def fetch_bitmap(self, uuid):
-        '''Fetches a complete texture cache bitmap. '''
-        
-
-        if uuid not in self.local_texture_cache.uuids:
-            raise TextureFetchException('UUID "%s" cache not found in local texture cache.' % uuid)
-
-        cache = self.local_texture_cache.get_cache(uuid)
-        body = self.fetcher.load_texture_body(uuid)
-
-        if body is None:
-            pixmap = convert_j2c_to_qpixmap(uuid, cache)
-        else:
-            pixmap = convert_j2c_to_qpixmap(uuid, cache + body)
-        return pixmap
+    def step(self):
+        ''' Fetches the next thumbnail. Returns False once none is left. '''
 
+        if self.thumbnails is None:
+            if not self.pending:
+                return False
+            self.thumbnails = self.fetch(self._take_pending())
 
-class TextureCacheFetcher(object):
+        try:
+            thumbnail = next(self.thumbnails)
+        except StopIteration:
+            self.thumbnails = None
+            if self.batcher is not None:
+                self.batcher.flush()
+            return bool(self.pending)
 
-    '''Handles texture fetch I/O.'''
+        if self.batcher is not None:
+            self.batcher.add(thumbnail)
+        return True
 
-    def __init__(self, entries_file_path):
-        self.set_entries_path(entries_file_path)
+    def cancel(self):
+        ''' Drops the queued indices and the thumbnails not yet delivered. '''
 
-    @property
-    def cache(self):
-        return self.local_texture_cache
+        self.pending.clear()
+        if self.thumbnails is not None:
+            self.thumbnails.close()
+            self.thumbnails = None
+        if self.batcher is not None:
+            self.batcher.discard()
 
-    def set_entries_path(self, entries_file_path):
-        '''Sets the entries file path.'''
+    def _take_pending(self):
+        while self.pending:
+            yield self.pending.popleft()
 
-        if not 'texture.entries' in entries_file_path:
-            ERROR('Invalid entries file path "%s"' % entries_file_path)
-            raise TextureFetchException('Invalid entries file path "%s"' % entries_file_path)
 
-        self.entries_path = entries_file_path
+class TextureCacheFetchService(QtCore.QObject):
 
-    def load_entry_file_contents(self):
-        ''' Loads the total entry file contents. '''
+    ''' Handles fetching of texture cache items.
 
-        with open(self.entries_path, 'rb') as entries_file:
-            return BytesIO(entries_file.read())
+    Thumbnails are emitted in batches through thumbnails_available,
+    so cross-thread signal traffic does not grow with each thumbnail.
+    They are either all fetched up front by fetch_thumbnails, or listed
+    by fetch_entries and fetched on demand by fetch_thumbnails_for or
+    a thumbnail_stream. '''
 
-    def load_cache_file_contents(self):
-        ''' Loads the total cache file contents. '''
+    thumbnails_available = QtCore.pyqtSignal(list)
+    entries_available = QtCore.pyqtSignal(TextureFetchEntries)
+    thumbnail_removed = QtCore.pyqtSignal(str)
+    bitmap_available = QtCore.pyqtSignal(TextureFetchBitmap)
 
-        with open(self.cache_path, 'rb') as cache_file:
-            return BytesIO(cache_file.read())
-        
+    def __init__(self, fetcher, worker_count=None, thumbnail_store=None,
+                 cache_max_bytes=TEXTURE_CACHE_HEAD_MAX_BYTES,
+                 bitmap_cache_max_bytes=BITMAP_CACHE_MAX_BYTES,
+                 batch_max_count=THUMBNAIL_BATCH_MAX_COUNT,
+                 batch_max_interval=THUMBNAIL_BATCH_MAX_INTERVAL, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.reader = TextureCacheReader(fetcher, worker_count, thumbnail_store,
+                                         cache_max_bytes, bitmap_cache_max_bytes)
+        self.batch_max_count = batch_max_count
+        self.batch_max_interval = batch_max_interval
 
     @property
-    def cache_directory(self):
-        ''' Returns absolute path to cache directory. '''
-
-        directory = os.path.dirname(self.entries_path)
-        return os.path.abspath(directory)
+    def fetcher(self):
+        return self.reader.fetcher
 
     @property
-    def cache_path(self):
-        ''' Returns the path to the cache file. '''
-
-        directory = self.cache_directory
-        return os.path.join(directory, 'texture.cache')
-
+    def decode_pool(self):
+        return self.reader.decode_pool
 
     @property
-    def header_byte_count(self):
-        ''' Calculates total header byte count. '''
-
-        total_bytes = (HEADER_ADDRESS_SIZE_BYTE_COUNT +
-                       HEADER_ENCODER_VERSION_BYTE_COUNT +
-                       HEADER_ENTRY_COUNT_BYTE_COUNT +
-                       HEADER_VERSION_BYTE_COUNT)
-
-        return total_bytes
-
-
-    def load_header(self, entries_file_contents):
-        '''Loads the texture cache header.'''
-
-        entries_file_contents.seek(0)
-        header = entries_file_contents.read(self.header_byte_count)
-        try:
-            unpacked = struct.unpack(HEADER_STRUCT_FORMAT, header)
-        except struct.error:
-            ERROR('Could not unpack texture cache header.', add_exception=True)
-            raise TextureFetchException('Failed to unpack texture cache header.')
-        version = '%0.2f' % unpacked[0]
-        address_size = unpacked[1]
-        encoder_version = unpacked[2].decode('utf-8').replace('\x00', '')
-        entry_count = unpacked[3]
+    def local_texture_cache(self):
+        return self.reader.local_texture_cache
 
-        INFO('Read header from texture cache.'
-             ' (VERSION: %s, ADDRESS_SIZE: %i, ENCODER_VERSION: %s, ENTRY_COUNT %i)'
-             % (version, address_size, encoder_version, entry_count))
-
-        return TextureCacheHeader(version, address_size, encoder_version, entry_count)
+    @property
+    def bitmap_cache(self):
+        return self.reader.bitmap_cache
 
     @property
-    def entry_byte_count(self):
-        ''' Calculates total entry byte count. '''
+    def thumbnail_store(self):
+        return self.reader.thumbnail_store
 
-        total_bytes = (ENTRY_BODY_SIZE_BYTE_COUNT +
-                       ENTRY_IMAGE_SIZE_BYTE_COUNT +
-                       ENTRY_TIME_BYTE_COUNT +
-                       ENTRY_UUID_BYTE_COUNT)
+    def set_fetcher(self, fetcher):
+        self.reader.set_fetcher(fetcher)
 
-        return total_bytes
+    def clear_local_cache(self):
+        self.reader.clear_local_cache()
 
+    def fetch_thumbnails(self, rebuild=True, max_time=None, fast=False):
+        '''Fetches texture cache thumbnails and UUID.
 
-    def load_entries(self, entries_file_contents, entry_count):
-        '''Loads the texture cache entries manifest.'''
+        Without rebuild, the entry table is diffed against the one from
+        the previous fetch: only added and changed entries are decoded,
+        removed entries are signalled through thumbnail_removed and the
+        previous time window is reused unless max_time is given.
 
-        entries_file_contents.seek(self.header_byte_count)
-        entries = []
-        for i in range(entry_count):
-            try:
-                entry_bytes = entries_file_contents.read(self.entry_byte_count)
-                unpack = struct.unpack(ENTRY_STRUCT_FORMAT, entry_bytes)
-            except struct.error:
-                WARN('Failed to load entry %i' % i)
-                continue
-            uuid = format_uuid_from_u8(unpack[0:16])
-            new_entry = TextureCacheEntry(uuid, *unpack[16:])
-            entries.append(new_entry)
+        In fast mode, thumbnails are the low-resolution images of the
+        fast cache and nothing is decoded. '''
 
-        INFO('Read %i entries from texture cache.' % len(entries))
+        update = self.reader.update_entries(rebuild, max_time)
 
-        if len(entries) != entry_count:
+        for uuid in update.removed:
+            self.thumbnail_removed.emit(uuid)
 
-            WARN('Number of read entries (%i) does not match expected count (%i)'
-                 % (len(entries), entry_count))
+        self._fetch_update(update, fast)
 
-        return entries
+    def fetch_entries(self, rebuild=True, max_time=None):
+        '''Lists the texture cache entries through entries_available
+        without fetching any thumbnails.
 
-    def load_texture_cache(self, cache_file_contents, entry_number, noseek=False):
-        ''' Loads texture cache from cache file contents given entry number.'''
+        Without rebuild, only the thumbnails of removed, added and
+        changed entries are reported stale. '''
 
-        if noseek:
-            return cache_file_contents.read(TEXTURE_CACHE_BYTE_COUNT)
-        else:
-            cache_file_contents.seek(TEXTURE_CACHE_BYTE_COUNT*entry_number)
-            return cache_file_contents.read(TEXTURE_CACHE_BYTE_COUNT)
+        update = self.reader.update_entries(rebuild, max_time)
 
+        for uuid in update.removed:
+            self.thumbnail_removed.emit(uuid)
 
-            
-    def load_texture_body(self, uuid):
+        invalidated = None
+        if not rebuild:
+            invalidated = list(update.removed)
+            invalidated.extend(update.entries.format_uuid(i) for i in update.indices)
 
-        ''' Returns the contents of a texture's body file. '''
+        self.entries_available.emit(TextureFetchEntries(self.reader.entry_snapshot,
+                                                        self.reader.window_indices(),
+                                                        invalidated))
 
-        subdir_name = uuid[0]
-        cache_dir = self.cache_directory
-        texture_file = uuid + '.texture'
-        path_to_body = os.path.join(cache_dir, subdir_name,texture_file)
+    def fetch_thumbnails_for(self, indices, fast=False):
+        '''Fetches the thumbnails of the given entry indices
+        of the entry table last listed. '''
 
-        if not os.path.exists(path_to_body):
-            INFO('Did not find texture body for "%s"' % uuid)
-            return None
+        if self.reader.last_update is None:
+            return
 
-        with open(path_to_body, 'rb') as body_file:
-            return body_file.read()
+        self._fetch_update(self.reader.select(indices), fast)
 
+    def thumbnail_stream(self, fast=False):
+        '''Returns a ThumbnailStream fetching the thumbnails of entry
+        indices of the entry table last listed through
+        thumbnails_available. '''
 
-class TextureCache(object):
-    
-    ''' Container/mapper for UUID and cache contents. '''
-    
-    def __init__(self):
-        self._cache = {}
+        def fetch(indices):
+            return self._iter_update(self.reader.select_lazily(indices), fast)
 
-    def __len__(self):
-        return len(self._cache.keys())
+        return ThumbnailStream(fetch, self._emit_thumbnails, self.batch_max_count,
+                               self.batch_max_interval)
 
-    @property
-    def uuids(self):
-        return self._cache.keys()
-
-    def add_cache(self, uuid, cache):
-        ''' Add cache contents for UUID '''
-        
-        self._cache[uuid] = cache
+    def prefill_stream(self):
+        '''Returns a ThumbnailStream decoding the thumbnails of entry
+        indices of the entry table last listed into the thumbnail
+        store, without emitting them. '''
 
-    def get_cache(self, uuid):
-        ''' Get cache contents for UUID '''
-        
-        try:
-            return self._cache[uuid]
-        except KeyError:
-            WARN('Did not find UUID "%s" in local cache contents.' % uuid)
+        def fetch(indices):
+            return self.reader.iter_thumbnails(self.reader.select_lazily(indices))
 
-    def delete_cache(self, uuid):
-        ''' Delete cache contents for UUID '''
-        
-        self._cache.pop(uuid)
+        return ThumbnailStream(fetch)
 
-    def clear(self):
-        ''' Clear cache contents '''
-        
-        self._cache = {}
+    def _fetch_update(self, update, fast=False):
 
+        batcher = ThumbnailBatcher(self._emit_thumbnails, self.batch_max_count,
+                                   self.batch_max_interval)
 
+        for new_thumbnail_item in self._iter_update(update, fast):
+            batcher.add(new_thumbnail_item)
 
-class TextureCacheHeader(object):
+        batcher.flush()
 
-    ''' Cache header data container. '''
+    def _iter_update(self, update, fast=False):
 
-    def __init__(self, version, address_size,
-                 encoder_version, entry_count):
+        if fast:
+            thumbnails = self.reader.iter_fast_thumbnails(update)
+        else:
+            thumbnails = self.reader.iter_thumbnails(update)
 
-        self.version = version
-        self.address_size = address_size
-        self.encoder_version = encoder_version
-        self.entry_count = entry_count
+        for entry, img in thumbnails:
+            with INSTRUMENTATION.stage('qt_conversion'):
+                new_thumbnail_item = TextureFetchThumbnail(entry, ndarray_to_qpixmap(img))
+            yield new_thumbnail_item
+            INSTRUMENTATION.log_summary()
 
+        INSTRUMENTATION.log_summary(force=True)
 
-class TextureCacheEntry(object):
+    def _emit_thumbnails(self, batch):
+        with INSTRUMENTATION.stage('batch_delivery'):
+            self.thumbnails_available.emit(batch)
 
-    ''' Cache entry data container. '''
+    def fetch_bitmap(self, uuid, reduce=0):
+        '''Fetches a complete texture cache bitmap as a pixmap,
+        reduced reduce times. '''
 
-    __slots__ = ['uuid', 'body_size', 'image_size', 'time']
+        return ndarray_to_qpixmap(self.reader.fetch_bitmap(uuid, reduce))
 
-    def __init__(self, uuid, body_size, image_size, time):
+    def decode_bitmap(self, uuid, reduce=0):
+        '''Decodes a complete texture cache bitmap to an ndarray,
+        reduced reduce times. '''
 
-        self.uuid = uuid
-        self.body_size = body_size
-        self.image_size = image_size
-        self.time = time
+        return self.reader.decode_bitmap(uuid, reduce)
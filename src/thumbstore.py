@@ -0,0 +1,166 @@
+'''
+Contains the persistent on-disk thumbnail store.
+'''
+
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+from utils import *
+
+
+class ThumbnailStore(object):
+
+    ''' SQLite store of decoded thumbnails that persists between sessions.
+
+    Thumbnails are keyed on the entry UUID, time, body size and image size
+    so an entry the viewer has rewritten is treated as a miss. The store
+    is trimmed back under max_bytes, least recently used first, on flush.
+
+    Writes and last use times are committed in batches, every
+    COMMIT_INTERVAL writes or COMMIT_SECONDS seconds, and on flush. The
+    stored byte count is kept as a running total.
+
+    variant identifies the decode settings the thumbnails were made with;
+    opening a store written with another variant empties it. '''
+
+    COMMIT_INTERVAL = 1000
+    COMMIT_SECONDS = 5.0
+    SCHEMA_VERSION = 2 # small columns ahead of the pixels so scans skip them
+
+    def __init__(self, path, max_bytes, variant=''):
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.variant = variant
+        self._connection = None
+        self._byte_count = 0
+        self._last_used = {}
+        self._uncommitted = 0
+        self._commit_time = time.perf_counter()
+
+    @property
+    def connection(self):
+        ''' Returns the database connection, opening it on first use. '''
+
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
+            stored_variant = '%i:%s' % (self.SCHEMA_VERSION, self.variant)
+            row = self._connection.execute(
+                "SELECT value FROM settings WHERE key = 'variant'").fetchone()
+            if row is None or row[0] != stored_variant:
+                INFO('Emptying thumbnail store made with other decode settings or layout.')
+                self._connection.execute('DROP TABLE IF EXISTS thumbnails')
+                self._connection.execute("INSERT OR REPLACE INTO settings VALUES ('variant', ?)",
+                                         (stored_variant,))
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS thumbnails ('
+                ' uuid TEXT PRIMARY KEY, time INTEGER, body_size INTEGER,'
+                ' image_size INTEGER, byte_count INTEGER, last_used REAL,'
+                ' shape TEXT, dtype TEXT, pixels BLOB)')
+            self._connection.commit()
+            row = self._connection.execute('SELECT TOTAL(byte_count) FROM thumbnails').fetchone()
+            self._byte_count = int(row[0])
+            INFO('Opened thumbnail store "%s".' % self.path)
+        return self._connection
+
+    def get(self, entry):
+        ''' Returns the stored thumbnail for an entry or None on a miss. '''
+
+        row = self.connection.execute(
+            'SELECT shape, dtype, pixels FROM thumbnails'
+            ' WHERE uuid = ? AND time = ? AND body_size = ? AND image_size = ?',
+            (entry.uuid, entry.time, entry.body_size, entry.image_size)).fetchone()
+        if row is None:
+            return None
+
+        shape, dtype, pixels = row
+        self._last_used[entry.uuid] = time.time()
+        self._count_write()
+        shape = tuple(int(dim) for dim in shape.split(','))
+        return np.frombuffer(pixels, dtype=dtype).reshape(shape)
+
+    def put(self, entry, thumbnail):
+        ''' Stores the thumbnail for an entry, replacing older versions. '''
+
+        if thumbnail is None:
+            return
+
+        pixels = np.ascontiguousarray(thumbnail).tobytes()
+        row = self.connection.execute('SELECT byte_count FROM thumbnails WHERE uuid = ?',
+                                      (entry.uuid,)).fetchone()
+        self.connection.execute(
+            'INSERT OR REPLACE INTO thumbnails (uuid, time, body_size, image_size,'
+            ' byte_count, last_used, shape, dtype, pixels) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (entry.uuid, entry.time, entry.body_size, entry.image_size, len(pixels), time.time(),
+             ','.join(str(dim) for dim in thumbnail.shape), thumbnail.dtype.str, pixels))
+        self._last_used.pop(entry.uuid, None)
+        self._byte_count += len(pixels) - (0 if row is None else row[0])
+        self._count_write()
+
+    def _count_write(self):
+        self._uncommitted += 1
+        if (self._uncommitted >= self.COMMIT_INTERVAL or
+                time.perf_counter() - self._commit_time >= self.COMMIT_SECONDS):
+            self.flush()
+
+    @property
+    def byte_count(self):
+        ''' Returns the total stored thumbnail byte count. '''
+
+        self.connection # opening the store loads the total
+        return self._byte_count
+
+    def flush(self):
+        ''' Commits pending writes and evicts down to the size budget. '''
+
+        if self._connection is None:
+            return
+
+        if self._last_used:
+            self.connection.executemany('UPDATE thumbnails SET last_used = ? WHERE uuid = ?',
+                                        [(used, uuid) for uuid, used in self._last_used.items()])
+            self._last_used.clear()
+
+        excess = self._byte_count - self.max_bytes
+        if excess > 0:
+            evicted = []
+            rows = self.connection.execute(
+                'SELECT uuid, byte_count FROM thumbnails ORDER BY last_used')
+            for uuid, byte_count in rows:
+                if excess <= 0:
+                    break
+                evicted.append((uuid,))
+                excess -= byte_count
+                self._byte_count -= byte_count
+            rows.close()
+            self.connection.executemany('DELETE FROM thumbnails WHERE uuid = ?', evicted)
+            INFO('Evicted %i thumbnails from thumbnail store.' % len(evicted))
+
+        self.connection.commit()
+        self._uncommitted = 0
+        self._commit_time = time.perf_counter()
+
+    def clear(self):
+        ''' Removes every stored thumbnail. '''
+
+        self.connection.execute('DELETE FROM thumbnails')
+        self.connection.commit()
+        self._byte_count = 0
+        self._last_used.clear()
+        self._uncommitted = 0
+
+    def close(self):
+        ''' Flushes and closes the store. '''
+
+        if self._connection is not None:
+            self.flush()
+            self._connection.close()
+            self._connection = None
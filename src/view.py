@@ -9,18 +9,23 @@ of the GUI/presentation.
 Contains the view/presentation layer.
 '''
 
+import numpy as np
 from PyQt5 import QtCore, QtGui, QtWidgets
 
 from appconfig import *
+from lru import LRUCache
+from qtutils import *
 from utils import *
 
 
 class MainWindow(QtWidgets.QMainWindow):
 
     refresh = QtCore.pyqtSignal()
+    watch = QtCore.pyqtSignal(bool)
     rebuild = QtCore.pyqtSignal(int)
     set_cache_path = QtCore.pyqtSignal(str)
     request_preview = QtCore.pyqtSignal(str)
+    cancel_preview = QtCore.pyqtSignal(str)
     request_save = QtCore.pyqtSignal(str, str)
     
     def __init__(self, parent=None):
@@ -30,13 +35,15 @@ class MainWindow(QtWidgets.QMainWindow):
         self.thumbnail_view = ThumbnailView()
         self.menu_bar = MenuBar()
         self.status = QtWidgets.QLabel()
+        self.preview_windows = {}
 
         # --- signal/slot
         self.menu_bar.open_texture_cache.connect(self.open_texture_cache)
         self.menu_bar.close.connect(self.close)
         self.menu_bar.refresh.connect(self.refresh_thumbnails)
+        self.menu_bar.watch.connect(self.watch)
 
-        self.thumbnail_view.request_preview.connect(self.request_preview)
+        self.thumbnail_view.request_preview.connect(self.open_preview)
         self.thumbnail_view.request_save.connect(self.save_bitmap)
         self.thumbnail_view.load_count_changed.connect(self.update_load_count)
         
@@ -60,6 +67,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
         if path:
             self.set_cache_path.emit(path)
+            self.menu_bar.set_cache_actions_enabled(True)
             time_window = TimeEntryView()
             time_window.exec_()
             seconds = time_window.seconds
@@ -70,10 +78,45 @@ class MainWindow(QtWidgets.QMainWindow):
     def refresh_thumbnails(self):
         self.refresh.emit()
 
-    def show_preview(self, uuid, image):
-        INFO('Showing preview for "%s".' % uuid)
-        preview_window = TexturePreviewView(uuid, image, self)
-        preview_window.show()
+    def open_preview(self, uuid):
+        ''' Requests a preview, or raises its window if already open.
+        Requested previews are tracked in preview_windows until their
+        window is closed. '''
+
+        if uuid not in self.preview_windows:
+            self.preview_windows[uuid] = None
+            self.request_preview.emit(uuid)
+        elif self.preview_windows[uuid] is not None:
+            self.preview_windows[uuid].raise_()
+            self.preview_windows[uuid].activateWindow()
+
+    def show_preview(self, uuid, image, reduce=0):
+        ''' Shows a pass of a progressive preview, opening its window
+        on the first one. Passes of closed previews are dropped. '''
+
+        if uuid not in self.preview_windows:
+            return
+
+        preview_window = self.preview_windows[uuid]
+        if preview_window is None:
+            INFO('Showing preview for "%s".' % uuid)
+            preview_window = TexturePreviewView(uuid, image, reduce, self)
+            preview_window.closed.connect(self.close_preview)
+            self.preview_windows[uuid] = preview_window
+            preview_window.show()
+        else:
+            preview_window.set_image(image, reduce)
+
+    def preview_failed(self, uuid):
+        ''' Forgets a preview whose request was cancelled or failed before
+        its window opened, so it can be requested again. '''
+
+        if uuid in self.preview_windows and self.preview_windows[uuid] is None:
+            del self.preview_windows[uuid]
+
+    def close_preview(self, uuid):
+        self.preview_windows.pop(uuid, None)
+        self.cancel_preview.emit(uuid)
 
     def update_load_count(self, count):
         self.status.setText('Loaded %i Textures' % count)
@@ -97,102 +140,273 @@ class MainWindow(QtWidgets.QMainWindow):
         
 
 
+class ThumbnailListModel(QtCore.QAbstractListModel):
+
+    ''' List model over the entries of a texture cache entry table,
+    in the order they are listed (newest first).
+
+    Thumbnails are only requested, through thumbnails_requested, for
+    rows the view displays or prefetches. Received thumbnails are kept
+    in a byte-budgeted pixmap cache and requested again once evicted. '''
+
+    thumbnails_requested = QtCore.pyqtSignal(list)
+
+    def __init__(self, max_bytes=THUMBNAIL_PIXMAP_CACHE_MAX_BYTES, parent=None):
+        QtCore.QAbstractListModel.__init__(self, parent)
+
+        # --- members
+        self.entries = None
+        self.indices = np.zeros(0, dtype=np.intp)
+        self.rows = np.zeros(0, dtype=np.intp)
+        self.pixmap_cache = LRUCache(max_bytes, sizeof=self.pixmap_byte_count)
+        self.requested = set()
+        self.request_queue = []
+        self.request_timer = QtCore.QTimer()
+        self.size_hint = QtCore.QSize(THUMBNAIL_ICON_SIZE + 320, THUMBNAIL_ICON_SIZE + 8)
+        self.min_icon_size = THUMBNAIL_ICON_SIZE // 2
+
+        # --- setup
+        self.request_timer.setSingleShot(True)
+        self.request_timer.setInterval(0)
+        self.request_timer.timeout.connect(self.flush_requests)
+
+    @staticmethod
+    def pixmap_byte_count(pixmap):
+        # failed thumbnails are cached as null pixmaps
+        return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8 + 64
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.indices)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+
+        if not index.isValid() or index.row() >= len(self.indices):
+            return None
+
+        entry_index = self.indices[index.row()]
+
+        if role == QtCore.Qt.DisplayRole:
+            return self.entries.format_uuid(entry_index)
+
+        elif role == QtCore.Qt.DecorationRole:
+            pixmap = self.pixmap_cache.get(self.entries.format_uuid(entry_index))
+            if pixmap is None:
+                self.request_rows(index.row(), index.row())
+                return None
+            return None if pixmap.isNull() else pixmap
+
+        elif role == QtCore.Qt.SizeHintRole:
+            return self.size_hint
+
+        elif role == QtCore.Qt.UserRole:
+            return int(self.entries.times[entry_index])
+
+        return None
+
+    def set_entries(self, fetch_entries):
+        ''' Lists the entries of a TextureFetchEntries, dropping
+        the stale thumbnails it reports. '''
+
+        self.beginResetModel()
+        self.entries = fetch_entries.entries
+        self.indices = fetch_entries.indices
+        # rows by entry index, -1 for entries not listed
+        self.rows = np.full(len(self.entries), -1, dtype=np.intp)
+        self.rows[self.indices] = np.arange(len(self.indices))
+        if fetch_entries.invalidated is None:
+            self.pixmap_cache.clear()
+        else:
+            for uuid in fetch_entries.invalidated:
+                self.pixmap_cache.discard(uuid)
+        self.requested = set()
+        self.request_queue = []
+        self.endResetModel()
+
+    def clear(self):
+        self.beginResetModel()
+        self.entries = None
+        self.indices = np.zeros(0, dtype=np.intp)
+        self.rows = np.zeros(0, dtype=np.intp)
+        self.pixmap_cache.clear()
+        self.requested = set()
+        self.request_queue = []
+        self.endResetModel()
+
+    def request_rows(self, first, last):
+        ''' Queues thumbnail requests for the rows first to last
+        that are neither cached nor already requested. '''
+
+        for row in range(max(first, 0), min(last, len(self.indices) - 1) + 1):
+            entry_index = int(self.indices[row])
+            if entry_index in self.requested:
+                continue
+            if self.entries.format_uuid(entry_index) in self.pixmap_cache:
+                continue
+            self.requested.add(entry_index)
+            self.request_queue.append(entry_index)
+
+        if self.request_queue and not self.request_timer.isActive():
+            self.request_timer.start()
+
+    def flush_requests(self):
+        if not self.request_queue:
+            return
+        request_queue, self.request_queue = self.request_queue, []
+        self.thumbnails_requested.emit(request_queue)
+
+    def add_thumbnails(self, thumbnails):
+        ''' Caches a batch of (entry index, uuid, thumbnail) thumbnails
+        and updates the rows showing them. '''
+
+        rows = []
+
+        for entry_index, uuid, thumbnail in thumbnails:
+            self.requested.discard(entry_index)
+            if thumbnail is None:
+                thumbnail = QtGui.QPixmap()
+            elif max(thumbnail.width(), thumbnail.height()) < self.min_icon_size:
+                # fast cache and small texture thumbnails are only a few pixels wide
+                thumbnail = thumbnail.scaled(self.min_icon_size, self.min_icon_size,
+                                             QtCore.Qt.KeepAspectRatio, QtCore.Qt.SmoothTransformation)
+            self.pixmap_cache.put(uuid, thumbnail)
+
+            # thumbnails requested before a refresh may no longer be listed
+            if entry_index >= len(self.rows) or self.rows[entry_index] < 0:
+                continue
+            if self.entries.format_uuid(entry_index) == uuid:
+                rows.append(int(self.rows[entry_index]))
+
+        if rows:
+            self.dataChanged.emit(self.index(min(rows)), self.index(max(rows)),
+                                  [QtCore.Qt.DecorationRole])
+
+
 class ThumbnailView(QtWidgets.QListView):
     
     request_preview = QtCore.pyqtSignal(str)
     request_save = QtCore.pyqtSignal(str, str)
+    request_thumbnails = QtCore.pyqtSignal(list)
     load_count_changed = QtCore.pyqtSignal(int)
     
     def __init__(self, parent=None):
         QtWidgets.QListView.__init__(self, parent)
 
         # --- members
-        self.local_item_model = QtGui.QStandardItemModel()
-        self.sort_proxy = QtCore.QSortFilterProxyModel()
-        self.refresher = QtCore.QTimer()
-        self.thumbnail_bulk = []
-        self.load_count = 0
+        self.thumbnail_model = ThumbnailListModel()
+        self.prefetch_timer = QtCore.QTimer()
 
         # --- signal/slot
         self.doubleClicked.connect(self.handle_double_click)
-        
+        self.thumbnail_model.thumbnails_requested.connect(self.request_thumbnails)
+        self.thumbnail_model.modelReset.connect(self.schedule_prefetch)
+        self.verticalScrollBar().valueChanged.connect(self.schedule_prefetch)
+        self.prefetch_timer.timeout.connect(self.prefetch)
 
         # --- setup
-        #self.sort_proxy.setSourceModel(self.local_item_model)
-        #self.sort_proxy.setSortRole(QtCore.Qt.UserRole)
-        #self.setModel(self.sort_proxy)
-        self.setModel(self.local_item_model)
-        self.setIconSize(QtCore.QSize(512,512))
+        self.setModel(self.thumbnail_model)
+        self.setIconSize(QtCore.QSize(THUMBNAIL_ICON_SIZE, THUMBNAIL_ICON_SIZE))
+        self.setUniformItemSizes(True)
         self.setWordWrap(True)
         self.setTextElideMode(QtCore.Qt.ElideRight)
-        self.refresher.timeout.connect(self.purge_bulk)
-        self.refresher.start(1000)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.setInterval(0)
         self.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
         self.customContextMenuRequested.connect(self.context_menu)
 
     def handle_double_click(self, index):
-        item = self.local_item_model.itemFromIndex(index)
-        if item is None:
+        if not index.isValid():
             return
-        uuid = item.text()
+        uuid = index.data()
         self.request_preview.emit(uuid)
 
     def context_menu(self, pos):
         global_pos = self.mapToGlobal(pos)
         index = self.indexAt(pos)
-        item = self.local_item_model.itemFromIndex(index)
-        INFO('Context menu request on thumbnail view for item "%r"' % item.text())
-        if item is None:
+        if not index.isValid():
             return
+        uuid = index.data()
+        INFO('Context menu request on thumbnail view for item "%r"' % uuid)
         menu = QtWidgets.QMenu()
-        menu.addAction('Copy UUID', lambda: self.copy_item_uuid(item))
-        menu.addAction('Save (BMP)', lambda: self.request_save.emit(item.text(), '.bmp'))
-        menu.addAction('Save (PNG)', lambda: self.request_save.emit(item.text(), '.png'))
+        menu.addAction('Copy UUID', lambda: copy_str_to_clipboard(uuid))
+        menu.addAction('Save (BMP)', lambda: self.request_save.emit(uuid, '.bmp'))
+        menu.addAction('Save (PNG)', lambda: self.request_save.emit(uuid, '.png'))
         menu.exec_(global_pos)
         self.persist_menu = menu
-    
-    def copy_item_uuid(self, item):
-        copy_str_to_clipboard(item.text())
-        
 
-    def clear(self):
-        self.local_item_model.clear()
-        self.load_count = 0
-        self.load_count_changed.emit(self.load_count)
+    def resizeEvent(self, event):
+        QtWidgets.QListView.resizeEvent(self, event)
+        self.schedule_prefetch()
 
-    def add_thumbnail(self, uuid, thumbnail, time):
-        
-        if thumbnail is None:
+    def schedule_prefetch(self):
+        if not self.prefetch_timer.isActive():
+            self.prefetch_timer.start()
+
+    def prefetch(self):
+        ''' Requests the thumbnails of the visible rows
+        and of one page of rows above and below them. '''
+
+        row_count = self.thumbnail_model.rowCount()
+        if row_count == 0:
             return
 
-        new_model_item = QtGui.QStandardItem(uuid)
-        new_model_item.setIcon(QtGui.QIcon(thumbnail))
-        new_model_item.setData(time, QtCore.Qt.UserRole)
-        new_model_item.setEditable(False)
-        self.thumbnail_bulk.append(new_model_item)
-        self.load_count += 1
-        self.load_count_changed.emit(self.load_count)
-    
-    def purge_bulk(self):
-        for item in self.thumbnail_bulk:
-            self.local_item_model.appendRow(item)
-        self.thumbnail_bulk = []
+        viewport_rect = self.viewport().rect()
+        first = self.indexAt(viewport_rect.topLeft())
+        last = self.indexAt(viewport_rect.bottomLeft())
+        first_row = first.row() if first.isValid() else 0
+        last_row = last.row() if last.isValid() else row_count - 1
+
+        page = last_row - first_row + 1
+        self.thumbnail_model.request_rows(first_row - page, last_row + page)
+
+    def clear(self):
+        self.thumbnail_model.clear()
+        self.load_count_changed.emit(0)
+
+    def set_entries(self, fetch_entries):
+        self.thumbnail_model.set_entries(fetch_entries)
+        self.load_count_changed.emit(self.thumbnail_model.rowCount())
+
+    def add_thumbnails(self, thumbnails):
+        self.thumbnail_model.add_thumbnails(thumbnails)
 
 
 class TexturePreviewView(QtWidgets.QDialog):
 
-    def __init__(self, uuid, image, parent=None):
+    ''' Preview window of a texture.
+
+    Images reduced reduce times are shown scaled up to full resolution
+    until a refined pass replaces them. closed is emitted with the UUID
+    when the window is closed. '''
+
+    closed = QtCore.pyqtSignal(str)
+
+    def __init__(self, uuid, image, reduce=0, parent=None):
         QtWidgets.QDialog.__init__(self, parent)
 
         # --- members
+        self.uuid = uuid
         self.image_widget = QtWidgets.QLabel()
 
+        # --- signal/slot
+        self.finished.connect(lambda result: self.closed.emit(self.uuid))
+
         # --- setup
         self.setWindowTitle('Preview: %s' % uuid)
-        self.image_widget.setPixmap(image)
+        self.setAttribute(QtCore.Qt.WA_DeleteOnClose)
+        self.set_image(image, reduce)
         self.setLayout(QtWidgets.QVBoxLayout())
         self.layout().addWidget(self.image_widget)
 
+    def set_image(self, image, reduce=0):
+        if image is None:
+            return
+        if reduce and not image.isNull():
+            image = image.scaled(image.width() << reduce, image.height() << reduce,
+                                 QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+        self.image_widget.setPixmap(image)
+
 
 
 
@@ -200,19 +414,24 @@ class MenuBar(QtWidgets.QMenuBar):
     
     open_texture_cache = QtCore.pyqtSignal()
     refresh = QtCore.pyqtSignal()
+    watch = QtCore.pyqtSignal(bool)
     close = QtCore.pyqtSignal()
     about = QtCore.pyqtSignal()
-    
+
+    CACHE_ACTION_NAMES = ('Refresh', 'Watch For Changes')
     
     def __init__(self, parent=None):
         QtWidgets.QMenuBar.__init__(self, parent)
 
         # --- menu schema
 
+        self.cache_actions = []
+
         menus = {
             'File': [('Open Texture Cache', self.open_texture_cache.emit),
                      (None, None), # sep
-                     #('Refresh', self.refresh.emit),
+                     ('Refresh', self.refresh.emit),
+                     ('Watch For Changes', self.watch.emit, True),
                      (None, None), # sep
                      ('Close', self.close.emit)],
 
@@ -220,17 +439,28 @@ class MenuBar(QtWidgets.QMenuBar):
         }
 
         self.load_menu_schema(menus)
+        self.set_cache_actions_enabled(False)
+
+    def set_cache_actions_enabled(self, enabled):
+        ''' Enables the actions that need an open texture cache. '''
+
+        for action in self.cache_actions:
+            action.setEnabled(enabled)
 
     def load_menu_schema(self, menu_schema):
         for menu_name, menu_actions in menu_schema.items():
             new_menu = QtWidgets.QMenu(menu_name, self)
-            for action_name, action_callback in menu_actions:
+            for menu_action in menu_actions:
+                action_name, action_callback = menu_action[:2]
                 if action_name is None and action_callback is None:
                     new_menu.addSeparator()
                 else:
                     new_action = QtWidgets.QAction(action_name, new_menu)
+                    new_action.setCheckable(len(menu_action) > 2 and menu_action[2])
                     new_action.triggered.connect(action_callback)
                     new_menu.addAction(new_action)
+                    if action_name in self.CACHE_ACTION_NAMES:
+                        self.cache_actions.append(new_action)
             self.addMenu(new_menu)
 
 class TimeEntryView(QtWidgets.QDialog):
@@ -0,0 +1,85 @@
+'''
+Contains the live texture cache watcher.
+'''
+
+import os
+
+from PyQt5 import QtCore
+
+from texturecache import CACHE_SUBDIRECTORY_NAMES
+from utils import *
+CACHE_FILE_NAMES = ('texture.entries', 'texture.cache')
+
+
+class TextureCacheWatcher(QtCore.QObject):
+
+    ''' Watches a texture cache directory and signals debounced changes.
+
+    Bursts of writes are coalesced: changed is emitted once writes have
+    been quiet for debounce_ms, or after max_delay_ms of continuous
+    writes so a busy viewer still gets refreshed. '''
+
+    changed = QtCore.pyqtSignal()
+
+    def __init__(self, debounce_ms, max_delay_ms, parent=None):
+        QtCore.QObject.__init__(self, parent)
+
+        # --- members
+        self.file_watcher = QtCore.QFileSystemWatcher(self)
+        self.debounce_timer = QtCore.QTimer(self)
+        self.burst_timer = QtCore.QElapsedTimer()
+        self.max_delay_ms = max_delay_ms
+        self.cache_directory = None
+
+        # --- setup
+        self.debounce_timer.setSingleShot(True)
+        self.debounce_timer.setInterval(debounce_ms)
+
+        # --- signal/slot
+        self.file_watcher.fileChanged.connect(self.handle_change)
+        self.file_watcher.directoryChanged.connect(self.handle_change)
+        self.debounce_timer.timeout.connect(self.changed)
+
+    @property
+    def watching(self):
+        return self.cache_directory is not None
+
+    @property
+    def watch_paths(self):
+        ''' Returns the cache files and body subdirectories to watch. '''
+
+        paths = [os.path.join(self.cache_directory, name) for name in CACHE_FILE_NAMES]
+        paths += [os.path.join(self.cache_directory, name) for name in CACHE_SUBDIRECTORY_NAMES]
+        return [path for path in paths if os.path.exists(path)]
+
+    def watch(self, cache_directory):
+        ''' Starts watching a texture cache directory. '''
+
+        self.stop()
+        self.cache_directory = cache_directory
+        self.file_watcher.addPaths(self.watch_paths)
+        INFO('Watching texture cache "%s".' % cache_directory)
+
+    def stop(self):
+        ''' Stops watching. '''
+
+        watched = self.file_watcher.files() + self.file_watcher.directories()
+        if watched:
+            self.file_watcher.removePaths(watched)
+        self.debounce_timer.stop()
+        self.cache_directory = None
+
+    def handle_change(self, path):
+
+        if not self.watching:
+            return
+
+        # files replaced by the viewer drop out of the watch list
+        if path not in self.file_watcher.files() and os.path.isfile(path):
+            self.file_watcher.addPath(path)
+
+        if not self.debounce_timer.isActive():
+            self.burst_timer.start()
+            self.debounce_timer.start()
+        elif self.burst_timer.elapsed() < self.max_delay_ms:
+            self.debounce_timer.start()
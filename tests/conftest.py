@@ -0,0 +1,20 @@
+'''
+Shared test fixtures.
+'''
+
+import sys
+import os
+import pytest
+
+src_path = os.path.abspath(os.path.join(__file__, '../../src'))
+sys.path.append(src_path)
+
+import j2c
+
+@pytest.fixture(autouse=True)
+def j2c_decoder_choice(tmp_path_factory, monkeypatch):
+    ''' Keeps decoder choices out of the user's application data
+    and selects the decoder afresh in every test. '''
+
+    monkeypatch.setattr(j2c, 'J2C_DECODER_CHOICE_PATH', str(tmp_path_factory.mktemp('j2c') / 'decoder.json'))
+    monkeypatch.setattr(j2c, '_j2c_decoder', None)
@@ -14,3 +14,20 @@ MOCK_ENTRIES_PATH = os.path.abspath(os.path.join(__file__, "../mock_texturecache
 EXPECTED_HEADER_BYTE_COUNT = 44
 EXPECTED_ENTRY_BYTE_COUNT = 28
 EXPECTED_ENTRY_COUNT = 527
+EXPECTED_FIRST_UUID = 'd07f6eed-b96a-47cd-b51d-400ad4a1c428'
+EXPECTED_FIRST_TEXTURE_SHAPE = (256, 256, 4)
+EXPECTED_FIRST_THUMBNAIL_SHAPE = (128, 128, 4)
+EXPECTED_FIRST_DECOMPOSITION_LEVELS = 5
+EXPECTED_ALPHA_COUNT = 208
+EXPECTED_FIRST_FAST_THUMBNAIL_SHAPE = (8, 8, 4)
+EXPECTED_FAST_CACHE_COUNT = 527
+EXPECTED_DECODED_COUNT = EXPECTED_ENTRY_COUNT
+
+# --- watcher test
+
+WATCH_TEST_DEBOUNCE_MS = 200
+WATCH_TEST_MAX_DELAY_MS = 2000
+
+# --- benchmark test
+
+GENERATED_ENTRY_COUNT = 50
@@ -0,0 +1,40 @@
+'''
+Tests for the synthetic cache generator and benchmark suite.
+'''
+
+import sys
+import os
+import pytest
+
+src_path = os.path.abspath(os.path.join(__file__, '../../src'))
+sys.path.append(src_path)
+benchmarks_path = os.path.abspath(os.path.join(__file__, '../../benchmarks'))
+sys.path.append(benchmarks_path)
+
+from tconfig import *
+
+from benchmark import run_benchmark
+from gencache import generate_cache
+from texturefetch import TextureCacheFetcher
+
+def test_generate_cache(tmp_path):
+    entries_path = generate_cache(str(tmp_path), GENERATED_ENTRY_COUNT)
+    fetcher = TextureCacheFetcher(entries_path)
+    entry_file_contents = fetcher.load_entry_file_contents()
+    header = fetcher.load_header(entry_file_contents)
+    entries = fetcher.load_entries(entry_file_contents, header.entry_count)
+    assert header.entry_count == GENERATED_ENTRY_COUNT
+    assert len(entries) == GENERATED_ENTRY_COUNT
+
+    cache_file_contents = fetcher.load_cache_file_contents()
+    for i in (0, GENERATED_ENTRY_COUNT - 1):
+        codestream = fetcher.load_codestream(cache_file_contents, i, entries.uuids[i])
+        assert len(codestream) == entries[i].image_size
+        assert codestream[:4] == b'\xff\x4f\xff\x51'
+
+def test_run_benchmark(tmp_path):
+    entries_path = generate_cache(str(tmp_path), GENERATED_ENTRY_COUNT)
+    results = run_benchmark(entries_path, decode_sample=10, worker_count=1)
+    assert results['entry_count'] == GENERATED_ENTRY_COUNT
+    assert results['stages']['signal_delivery']['items'] == 10
+    assert results['stages']['full_run']['items'] == GENERATED_ENTRY_COUNT
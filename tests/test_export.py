@@ -0,0 +1,63 @@
+'''
+Tests for headless bulk export.
+'''
+
+import sys
+import os
+import pytest
+
+src_path = os.path.abspath(os.path.join(__file__, '../../src'))
+sys.path.append(src_path)
+
+from PIL import Image
+
+from tconfig import *
+
+import export
+from export import TextureCacheExporter, export_texture_job, main
+from texturefetch import TextureCacheFetcher
+
+@pytest.fixture
+def texture_fetcher():
+    fetcher = TextureCacheFetcher(MOCK_ENTRIES_PATH)
+    return fetcher
+
+def test_export_j2c_resumes(texture_fetcher, tmp_path):
+    exporter = TextureCacheExporter(texture_fetcher, str(tmp_path), 'j2c', 1)
+    reports = []
+    assert exporter.export(report=reports.append) == (EXPECTED_ENTRY_COUNT, 0, 0)
+    assert len(os.listdir(str(tmp_path))) == EXPECTED_ENTRY_COUNT
+    assert exporter.export(report=reports.append) == (0, EXPECTED_ENTRY_COUNT, 0)
+    assert 'textures/s' in reports[-1]
+
+def test_export_png(texture_fetcher, tmp_path):
+    cache_file_contents = texture_fetcher.load_cache_file_contents()
+    codestream = texture_fetcher.load_codestream(cache_file_contents, 0, EXPECTED_FIRST_UUID)
+    path = str(tmp_path / (EXPECTED_FIRST_UUID + '.png'))
+    assert export_texture_job((EXPECTED_FIRST_UUID, codestream, path, 'png')) == (EXPECTED_FIRST_UUID, True)
+    assert Image.open(path).size == EXPECTED_FIRST_TEXTURE_SHAPE[1::-1]
+
+def test_export_time_filter(tmp_path):
+    assert main([MOCK_ENTRIES_PATH, str(tmp_path), '--format', 'j2c', '--max-time', '60']) == 0
+    assert os.listdir(str(tmp_path)) == []
+
+def test_export_job_failures(texture_fetcher, tmp_path):
+    cache_file_contents = texture_fetcher.load_cache_file_contents()
+    codestream = texture_fetcher.load_codestream(cache_file_contents, 0, EXPECTED_FIRST_UUID)
+
+    # corrupt codestreams and unwritable paths fail their own job only
+    corrupt_path = str(tmp_path / 'corrupt.png')
+    assert export_texture_job((EXPECTED_FIRST_UUID, b'\x00' * 64, corrupt_path, 'png')) == (EXPECTED_FIRST_UUID, False)
+    missing_path = str(tmp_path / 'missing' / 'texture.j2c')
+    assert export_texture_job((EXPECTED_FIRST_UUID, codestream, missing_path, 'j2c')) == (EXPECTED_FIRST_UUID, False)
+    assert os.listdir(str(tmp_path)) == []
+
+def test_export_interrupted(texture_fetcher, tmp_path, monkeypatch):
+    monkeypatch.setattr(export, 'PROGRESS_INTERVAL', 0)
+    exporter = TextureCacheExporter(texture_fetcher, str(tmp_path), 'j2c', 2)
+    def interrupt(message):
+        raise KeyboardInterrupt()
+    with pytest.raises(KeyboardInterrupt):
+        exporter.export(report=interrupt)
+    assert exporter.decode_pool._executor is None
+    assert 0 < len(os.listdir(str(tmp_path))) < EXPECTED_ENTRY_COUNT
@@ -0,0 +1,45 @@
+'''
+Tests for the read-ahead stage.
+'''
+
+import sys
+import os
+import pytest
+
+src_path = os.path.abspath(os.path.join(__file__, '../../src'))
+sys.path.append(src_path)
+
+from tconfig import *
+
+from readahead import ReadAhead
+
+def test_read_ahead_order():
+    read_ahead = ReadAhead(count=4, max_bytes=100, worker_count=2)
+    results = list(read_ahead.map(lambda item: item * 2, iter(range(50))))
+    read_ahead.shutdown()
+    assert results == [(i, i * 2) for i in range(50)]
+
+def test_read_ahead_limits():
+    consumed = []
+    def items():
+        for i in range(20):
+            consumed.append(i)
+            yield i
+
+    read_ahead = ReadAhead(count=3, max_bytes=100, worker_count=2)
+    for item, _ in read_ahead.map(lambda item: item, items()):
+        # count reads in flight, and the item waiting for a free slot
+        assert len(consumed) <= item + 4
+    read_ahead.shutdown()
+
+    consumed.clear()
+    read_ahead = ReadAhead(count=8, max_bytes=100, worker_count=2)
+    for item, _ in read_ahead.map(lambda item: item, items(), size=lambda item: 60):
+        # the byte cap leaves a single 60 byte read in flight
+        assert len(consumed) <= item + 2
+    read_ahead.shutdown()
+
+def test_read_ahead_disabled():
+    read_ahead = ReadAhead(count=0)
+    assert list(read_ahead.map(lambda item: item * 2, range(5))) == [(i, i * 2) for i in range(5)]
+    assert read_ahead._executor is None
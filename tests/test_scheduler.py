@@ -0,0 +1,60 @@
+'''
+Tests for the job scheduler.
+'''
+
+import sys
+import os
+import pytest
+
+src_path = os.path.abspath(os.path.join(__file__, '../../src'))
+sys.path.append(src_path)
+
+from tconfig import *
+
+from scheduler import *
+
+def test_scheduler_priorities():
+    scheduler = JobScheduler()
+    ran = []
+    scheduler.submit(PRIORITY_PREFILL, ran.append, 'prefill 1')
+    scheduler.submit(PRIORITY_PREFILL, ran.append, 'prefill 2')
+    scheduler.submit(PRIORITY_VISIBLE, ran.append, 'visible 1', newest_first=True)
+    scheduler.submit(PRIORITY_VISIBLE, ran.append, 'visible 2', newest_first=True)
+    scheduler.submit(PRIORITY_INTERACTIVE, ran.append, 'preview')
+    while scheduler.run_next():
+        pass
+    assert ran == ['preview', 'visible 2', 'visible 1', 'prefill 1', 'prefill 2']
+
+def test_scheduler_cancel():
+    scheduler = JobScheduler()
+    ran = []
+    def rebuild():
+        ran.append('rebuild')
+        scheduler.cancel()
+        scheduler.submit(PRIORITY_PREFILL, ran.append, 'new prefill')
+    scheduler.submit(PRIORITY_INTERACTIVE, rebuild)
+    scheduler.submit(PRIORITY_PREFILL, ran.append, 'old prefill')
+    assert scheduler.run_for(60) == 2
+    assert ran == ['rebuild', 'new prefill']
+    assert len(scheduler) == 0
+
+def test_scheduler_cancel_priorities():
+    scheduler = JobScheduler()
+    ran = []
+    scheduler.submit(PRIORITY_INTERACTIVE, ran.append, 'save')
+    scheduler.submit(PRIORITY_VISIBLE, ran.append, 'visible')
+    scheduler.submit(PRIORITY_PREFILL, ran.append, 'prefill')
+    scheduler.cancel((PRIORITY_VISIBLE, PRIORITY_PREFILL))
+    scheduler.submit(PRIORITY_PREFILL, ran.append, 'new prefill')
+    assert scheduler.run_for(60) == 2
+    assert ran == ['save', 'new prefill']
+
+def test_scheduler_job_errors():
+    scheduler = JobScheduler()
+    ran = []
+    def fail():
+        raise ValueError('failed job')
+    scheduler.submit(PRIORITY_INTERACTIVE, fail)
+    scheduler.submit(PRIORITY_VISIBLE, ran.append, 'next')
+    assert scheduler.run_for(60) == 2
+    assert ran == ['next']
@@ -5,6 +5,13 @@ Tests for texture fetching.
 
 import sys
 import os
+import json
+import shutil
+import struct
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pytest
 
 src_path = os.path.abspath(os.path.join(__file__, '../../src'))
@@ -16,6 +23,15 @@ from tconfig import *
 
 from texturefetch import TextureCacheFetchService
 from texturefetch import TextureCacheFetcher
+from texturefetch import TEXTURE_CACHE_BYTE_COUNT
+from texturecache import iter_entries, iter_textures, TextureBodyIndex
+import texturecache
+from j2c import decode_j2c, decode_j2c_in_memory, parse_j2c_heads, thumbnail_decode_parameters
+import j2c
+import decodepool
+from thumbstore import ThumbnailStore
+from instrument import INSTRUMENTATION, Instrumentation
+from readahead import ReadAhead
 
 @pytest.fixture
 def qapp():
@@ -27,6 +43,11 @@ def texture_fetcher():
     fetcher = TextureCacheFetcher(MOCK_ENTRIES_PATH)
     return fetcher
 
+@pytest.fixture
+def mapped_texture_fetcher():
+    fetcher = TextureCacheFetcher(MOCK_ENTRIES_PATH, memory_mapped=True)
+    return fetcher
+
 @pytest.fixture
 def texture_fetch_service():
     fetcher = TextureCacheFetcher(MOCK_ENTRIES_PATH)
@@ -52,10 +73,481 @@ def test_load_entries(texture_fetcher):
 
 def test_load_thumbnails(qapp, texture_fetch_service):
     thumbnails = []
-    def add_thumbnail(thumbnail):
-        thumbnails.append(thumbnail)
-    texture_fetch_service.thumbnail_available.connect(add_thumbnail)
+    texture_fetch_service.thumbnails_available.connect(thumbnails.extend)
     texture_fetch_service.fetch_thumbnails()
     assert len(thumbnails) == EXPECTED_ENTRY_COUNT
 
 
+
+def test_decode_j2c_in_memory(texture_fetcher):
+    entries_file_contents = texture_fetcher.load_entry_file_contents()
+    cache_file_contents = texture_fetcher.load_cache_file_contents()
+    entries = texture_fetcher.load_entries(entries_file_contents, EXPECTED_ENTRY_COUNT)
+    uuid = entries[0].uuid
+    cache = texture_fetcher.load_texture_cache(cache_file_contents, 0)
+    body = texture_fetcher.load_texture_body(uuid)
+    img = decode_j2c_in_memory(bytes(cache) + body)
+    assert img.shape == EXPECTED_FIRST_TEXTURE_SHAPE
+    thumbnail = decode_j2c(uuid, bytes(cache) + body, thumbnail=True)
+    assert thumbnail.shape == EXPECTED_FIRST_THUMBNAIL_SHAPE
+
+def test_assemble_codestream(texture_fetcher):
+    entries = texture_fetcher.load_entry_table()
+    cache_file_contents = texture_fetcher.load_cache_file_contents()
+    mismatched = 0
+    for i in entries.select_indices():
+        entry = entries[i]
+        cache = bytes(texture_fetcher.load_texture_cache(cache_file_contents, i))
+        body = texture_fetcher.load_texture_body(entry.uuid) or b''
+        codestream = texture_fetcher.load_codestream(cache_file_contents, i, entry.uuid, entry.image_size)
+        assert isinstance(codestream, bytearray)
+        if body or entry.image_size >= len(cache):
+            assert codestream == cache + body
+        else:
+            # heads of small codestreams are cut to their listed size
+            assert codestream == cache[:entry.image_size]
+        mismatched += len(codestream) != entry.image_size
+    assert len(texture_fetcher.size_mismatches) == mismatched > 0
+
+    codestream = texture_fetcher.load_codestream(cache_file_contents, 0, EXPECTED_FIRST_UUID)
+    assert decode_j2c_in_memory(codestream).shape == EXPECTED_FIRST_TEXTURE_SHAPE
+    assert decode_j2c_in_memory(memoryview(codestream)).shape == EXPECTED_FIRST_TEXTURE_SHAPE
+
+def test_entry_table(texture_fetcher):
+    entries_file_contents = texture_fetcher.load_entry_file_contents()
+    entries = texture_fetcher.load_entries(entries_file_contents, EXPECTED_ENTRY_COUNT)
+    assert entries.records.dtype.itemsize == EXPECTED_ENTRY_BYTE_COUNT
+    assert len(entries.uuids) == EXPECTED_ENTRY_COUNT
+    assert entries[0].uuid == EXPECTED_FIRST_UUID
+    assert entries[0].image_size == entries[0].body_size + TEXTURE_CACHE_BYTE_COUNT
+
+def test_memory_mapped_contents(texture_fetcher, mapped_texture_fetcher):
+    entries_file_contents = mapped_texture_fetcher.load_entry_file_contents()
+    cache_file_contents = mapped_texture_fetcher.load_cache_file_contents()
+    header = mapped_texture_fetcher.load_header(entries_file_contents)
+    entries = mapped_texture_fetcher.load_entries(entries_file_contents, header.entry_count)
+    assert len(entries) == EXPECTED_ENTRY_COUNT
+    cache = mapped_texture_fetcher.load_texture_cache(cache_file_contents, 1)
+    assert isinstance(cache, memoryview)
+    expected = texture_fetcher.load_texture_cache(texture_fetcher.load_cache_file_contents(), 1)
+    assert cache == expected
+
+def test_load_thumbnails_parallel(qapp):
+    decoded = {}
+    def add_thumbnails(thumbnails):
+        for thumbnail in thumbnails:
+            decoded[thumbnail.uuid] = thumbnail.thumbnail is not None
+    for worker_count in (1, 2):
+        fetch_service = TextureCacheFetchService(TextureCacheFetcher(MOCK_ENTRIES_PATH), worker_count)
+        fetch_service.thumbnails_available.connect(add_thumbnails)
+        fetch_service.fetch_thumbnails()
+        fetch_service.decode_pool.shutdown()
+        assert len(decoded) == EXPECTED_ENTRY_COUNT
+        assert sum(decoded.values()) == EXPECTED_DECODED_COUNT
+        decoded.clear()
+
+def test_thumbnail_store(qapp, tmp_path, monkeypatch):
+    store = ThumbnailStore(str(tmp_path / 'thumbnails.sqlite'), 1024 * 1024 * 1024)
+    fetch_service = TextureCacheFetchService(TextureCacheFetcher(MOCK_ENTRIES_PATH), 1, store)
+    thumbnails = []
+    fetch_service.thumbnails_available.connect(thumbnails.extend)
+    fetch_service.fetch_thumbnails()
+    decoded = [thumbnail.uuid for thumbnail in thumbnails if thumbnail.thumbnail is not None]
+    assert len(decoded) == EXPECTED_DECODED_COUNT
+
+    monkeypatch.setattr(decodepool, 'decode_j2c', lambda *args, **kwargs: None)
+    thumbnails.clear()
+    fetch_service.fetch_thumbnails()
+    stored = [thumbnail.uuid for thumbnail in thumbnails if thumbnail.thumbnail is not None]
+    assert sorted(stored) == sorted(decoded)
+
+    def total_bytes():
+        return store.connection.execute('SELECT TOTAL(byte_count) FROM thumbnails').fetchone()[0]
+    assert store.byte_count == total_bytes()
+    assert store._last_used
+    store.max_bytes = store.byte_count // 2
+    store.flush()
+    assert not store._last_used
+    assert 0 < store.byte_count == total_bytes() <= store.max_bytes
+    store.close()
+
+def test_incremental_refresh(qapp, tmp_path):
+    cache_directory = str(tmp_path / 'texturecache')
+    shutil.copytree(os.path.dirname(MOCK_ENTRIES_PATH), cache_directory)
+    entries_path = os.path.join(cache_directory, 'texture.entries')
+    fetch_service = TextureCacheFetchService(TextureCacheFetcher(entries_path), 1)
+    thumbnails = []
+    removed = []
+    fetch_service.thumbnails_available.connect(thumbnails.extend)
+    fetch_service.thumbnail_removed.connect(removed.append)
+    fetch_service.fetch_thumbnails()
+    assert len(thumbnails) == EXPECTED_ENTRY_COUNT
+
+    # free the first entry slot and touch the second entry
+    with open(entries_path, 'r+b') as entries_file:
+        entries_file.seek(EXPECTED_HEADER_BYTE_COUNT + 16)
+        entries_file.write(struct.pack('<i', -1))
+        entries_file.seek(EXPECTED_HEADER_BYTE_COUNT + EXPECTED_ENTRY_BYTE_COUNT + 24)
+        entries_file.write(struct.pack('<I', 2**31))
+
+    thumbnails.clear()
+    fetch_service.fetch_thumbnails(rebuild=False)
+    assert removed == [EXPECTED_FIRST_UUID]
+    assert len(thumbnails) == 1
+    assert thumbnails[0].time == 2**31
+    assert thumbnails[0].thumbnail is not None
+
+    thumbnails.clear()
+    removed.clear()
+    fetch_service.fetch_thumbnails(rebuild=False)
+    assert not thumbnails and not removed
+
+def test_body_index(tmp_path):
+    cache_directory = str(tmp_path / 'texturecache')
+    shutil.copytree(os.path.dirname(MOCK_ENTRIES_PATH), cache_directory)
+    fetcher = TextureCacheFetcher(os.path.join(cache_directory, 'texture.entries'))
+    body_index = TextureBodyIndex(cache_directory)
+    body_index.refresh()
+
+    body_uuid = next(iter_body_uuids(cache_directory))
+    body_path = body_index.path(body_uuid)
+    assert body_index.size(body_uuid) == os.path.getsize(body_path)
+    assert fetcher.load_texture_body(body_uuid) is not None
+
+    # a removed body is only noticed once its directory is relisted
+    os.remove(body_path)
+    stat = os.stat(os.path.dirname(body_path))
+    os.utime(os.path.dirname(body_path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    body_index.refresh()
+    assert body_index.size(body_uuid) is None
+    assert fetcher.load_texture_body(body_uuid, refresh=True) is None
+
+def iter_body_uuids(cache_directory):
+    for name in sorted(os.listdir(cache_directory)):
+        directory = os.path.join(cache_directory, name)
+        if os.path.isdir(directory):
+            for file_name in sorted(os.listdir(directory)):
+                if file_name.endswith('.texture'):
+                    yield file_name[:-len('.texture')]
+
+def test_local_cache_eviction(qapp):
+    cache_max_bytes = 10 * TEXTURE_CACHE_BYTE_COUNT
+    fetch_service = TextureCacheFetchService(TextureCacheFetcher(MOCK_ENTRIES_PATH), 1,
+                                             cache_max_bytes=cache_max_bytes)
+    fetch_service.fetch_thumbnails()
+    local_texture_cache = fetch_service.local_texture_cache
+    assert len(local_texture_cache) == EXPECTED_ENTRY_COUNT
+    assert local_texture_cache.statistics['bytes'] <= cache_max_bytes
+    assert local_texture_cache.statistics['evictions'] == EXPECTED_ENTRY_COUNT - 10
+
+    # entries are fetched newest first, so the newest heads were evicted
+    newest_uuid = next(iter_entries(MOCK_ENTRIES_PATH)).uuid
+    fetch_service.decode_bitmap(newest_uuid)
+    assert local_texture_cache.statistics['misses'] == 1
+    fetch_service.decode_bitmap(newest_uuid)
+    assert local_texture_cache.statistics['hits'] == 1
+
+    # the oldest entry was fetched last
+    pixmap = fetch_service.fetch_bitmap(EXPECTED_FIRST_UUID)
+    assert pixmap.width() == EXPECTED_FIRST_TEXTURE_SHAPE[1]
+    assert local_texture_cache.statistics['misses'] == 1
+
+    # evicted heads are not reloaded from a slot that now holds another UUID
+    entry_snapshot = fetch_service.reader.entry_snapshot
+    local_texture_cache._cache.discard(newest_uuid)
+    local_texture_cache._indices[newest_uuid] = entry_snapshot.find(EXPECTED_FIRST_UUID)
+    assert local_texture_cache.get_cache(newest_uuid) is None
+    assert newest_uuid not in local_texture_cache.uuids
+
+    # but are looked up in the entry table again
+    assert fetch_service.decode_bitmap(newest_uuid) is not None
+    assert local_texture_cache._indices[newest_uuid] == entry_snapshot.find(newest_uuid)
+
+def test_bitmap_cache(qapp):
+    fetch_service = TextureCacheFetchService(TextureCacheFetcher(MOCK_ENTRIES_PATH), 1)
+    fetch_service.fetch_thumbnails()
+    first = fetch_service.fetch_bitmap(EXPECTED_FIRST_UUID)
+    second = fetch_service.fetch_bitmap(EXPECTED_FIRST_UUID)
+    assert first.toImage() == second.toImage()
+    assert fetch_service.bitmap_cache.statistics['misses'] == 1
+    assert fetch_service.bitmap_cache.statistics['hits'] == 1
+    fetch_service.clear_local_cache()
+    assert len(fetch_service.bitmap_cache) == 0
+
+def test_instrumentation(qapp):
+    fetch_service = TextureCacheFetchService(TextureCacheFetcher(MOCK_ENTRIES_PATH), 1)
+    INSTRUMENTATION.reset()
+    fetch_service.fetch_thumbnails()
+    assert INSTRUMENTATION.snapshot() == {}
+
+    INSTRUMENTATION.enabled = True
+    try:
+        fetch_service.fetch_thumbnails()
+    finally:
+        INSTRUMENTATION.enabled = False
+    stages = INSTRUMENTATION.snapshot()
+    INSTRUMENTATION.reset()
+    assert stages['entry_parse']['count'] == 1
+    assert stages['decode']['count'] == EXPECTED_ENTRY_COUNT
+    assert stages['qt_conversion']['count'] == EXPECTED_ENTRY_COUNT
+    assert stages['batch_delivery']['count'] >= 1
+    assert sum(stages['decode']['histogram_us'].values()) == EXPECTED_ENTRY_COUNT
+
+def test_instrumentation_threads():
+    instrumentation = Instrumentation(enabled=True)
+    def record(thread_number):
+        for i in range(1000):
+            instrumentation.record('stage %i' % (i % 8), 1e-6)
+            instrumentation.record('shared', 1e-6)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(record, range(4)))
+    stages = instrumentation.snapshot()
+    assert stages['shared']['count'] == 4000
+    assert sum(stage['count'] for stage in stages.values()) == 8000
+
+def test_iter_entries():
+    entries = list(iter_entries(MOCK_ENTRIES_PATH))
+    assert len(entries) == EXPECTED_ENTRY_COUNT
+    assert [entry.time for entry in entries] == sorted((entry.time for entry in entries), reverse=True)
+    assert entries[-1].uuid == EXPECTED_FIRST_UUID
+    assert entries[-1].index == 0
+    since = sorted(entry.time for entry in entries)[-10]
+    assert all(entry.time >= since for entry in iter_entries(MOCK_ENTRIES_PATH, since))
+    assert len(list(iter_entries(MOCK_ENTRIES_PATH, since))) >= 10
+
+def test_iter_closes_fetcher(monkeypatch):
+    closed = []
+    close = texturecache.TextureCacheFetcher.close
+    def record_close(fetcher):
+        mappings = list(fetcher._mappings.values())
+        close(fetcher)
+        closed.append(all(mapping.closed for mapping in mappings) and not fetcher._retired_mappings)
+    monkeypatch.setattr(texturecache.TextureCacheFetcher, 'close', record_close)
+
+    assert len(list(iter_entries(MOCK_ENTRIES_PATH))) == EXPECTED_ENTRY_COUNT
+    textures = iter_textures(MOCK_ENTRIES_PATH)
+    entry, codestream = next(textures)
+    textures.close()
+    assert closed == [True, True]
+
+def test_time_index(texture_fetcher):
+    entries = texture_fetcher.load_entry_table()
+    times = entries.times
+    since, until = sorted(set(times))[5], sorted(set(times))[-5]
+    selected = entries.select_indices(since, until)
+    expected = [i for i in entries.valid_indices if since <= times[i] <= until]
+    assert sorted(selected) == expected
+    assert list(times[selected]) == sorted(times[selected], reverse=True)
+    assert len(entries.select_window(0)) == 0
+    assert len(entries.select_window()) == EXPECTED_ENTRY_COUNT
+
+def test_iter_textures_without_qt(tmp_path):
+    script = ('import sys; sys.path.append(%r)\n'
+              'import j2c; j2c.J2C_DECODER_CHOICE_PATH = %r\n'
+              'from texturecache import iter_textures\n'
+              'decoded = sum(img is not None for entry, img in\n'
+              '              iter_textures(%r, decode=True, thumbnail=True))\n'
+              'assert decoded == %i, decoded\n'
+              'assert not [name for name in sys.modules if name.startswith("PyQt5")]\n'
+              % (src_path, str(tmp_path / 'decoder.json'), MOCK_ENTRIES_PATH,
+                 EXPECTED_DECODED_COUNT))
+    subprocess.check_call([sys.executable, '-c', script])
+
+def test_thumbnail_batches(qapp):
+    fetch_service = TextureCacheFetchService(TextureCacheFetcher(MOCK_ENTRIES_PATH), 1,
+                                             batch_max_count=100, batch_max_interval=3600)
+    batches = []
+    fetch_service.thumbnails_available.connect(batches.append)
+    fetch_service.fetch_thumbnails()
+    assert sum(len(batch) for batch in batches) == EXPECTED_ENTRY_COUNT
+    assert [len(batch) for batch in batches[:-1]] == [100] * (len(batches) - 1)
+
+def test_thumbnail_stream(qapp):
+    fetch_service = TextureCacheFetchService(TextureCacheFetcher(MOCK_ENTRIES_PATH), 1,
+                                             batch_max_count=1)
+    fetch_service.reader.body_read_ahead = ReadAhead(0)
+    fetch_service.fetch_entries()
+    indices = list(fetch_service.reader.window_indices())
+    batches = []
+    fetch_service.thumbnails_available.connect(batches.append)
+    stream = fetch_service.thumbnail_stream()
+    stream.add(indices[:4])
+    assert stream.step()
+    thumbnails = stream.thumbnails
+    stream.add(indices[4:8])
+    steps = 1
+    while stream.step():
+        steps += 1
+        if stream.thumbnails is not None:
+            assert stream.thumbnails is thumbnails
+    assert steps == 8
+    delivered = [item.entry.index for batch in batches for item in batch]
+    assert delivered == indices[:1] + indices[4:8] + indices[1:4]
+    stream.add(indices[8:12])
+    stream.cancel()
+    assert not stream.step()
+
+def test_fast_cache(texture_fetcher):
+    fast_cache = texture_fetcher.load_fast_cache()
+    assert len(fast_cache) == EXPECTED_ENTRY_COUNT
+    assert fast_cache.valid.sum() == EXPECTED_FAST_CACHE_COUNT
+    img = fast_cache.get(0)
+    assert img.shape == EXPECTED_FIRST_FAST_THUMBNAIL_SHAPE
+
+    # fast cache images match a decode at their discard level
+    contents = texture_fetcher.load_cache_file_contents()
+    codestream = texture_fetcher.load_codestream(contents, 0, EXPECTED_FIRST_UUID)
+    decoded = decode_j2c_in_memory(codestream, int(fast_cache.records['discard_level'][0]))
+    assert abs(decoded.astype(int) - img.astype(int)).mean() < 2
+
+def test_fast_cache_close(mapped_texture_fetcher):
+    fast_cache = mapped_texture_fetcher.load_fast_cache()
+    mapping = fast_cache._mapping
+    assert fast_cache.get(0) is not None
+
+    # reloading closes the fast cache loaded before, closing the fetcher the last one
+    reloaded = mapped_texture_fetcher.load_fast_cache()
+    assert mapping.closed and fast_cache.get(0) is None
+    mapping = reloaded._mapping
+    mapped_texture_fetcher.close()
+    assert mapping.closed and reloaded.get(0) is None
+
+def test_fast_thumbnails(qapp, monkeypatch):
+    def fail_decode(*args, **kwargs):
+        raise AssertionError('decoded in fast mode')
+    monkeypatch.setattr(decodepool, 'decode_j2c', fail_decode)
+    fetch_service = TextureCacheFetchService(TextureCacheFetcher(MOCK_ENTRIES_PATH), 1)
+    thumbnails = []
+    fetch_service.thumbnails_available.connect(thumbnails.extend)
+    fetch_service.fetch_thumbnails(fast=True)
+    assert len(thumbnails) == EXPECTED_ENTRY_COUNT
+    assert sum(thumbnail.thumbnail is not None for thumbnail in thumbnails) == EXPECTED_FAST_CACHE_COUNT
+
+def test_j2c_metadata(texture_fetcher):
+    entries = texture_fetcher.load_entry_table()
+    metadata = texture_fetcher.load_metadata(texture_fetcher.load_cache_file_contents(), len(entries))
+    assert len(metadata) == EXPECTED_ENTRY_COUNT
+    assert metadata.valid.all()
+    first = metadata[0]
+    assert (first['height'], first['width'], first['components']) == EXPECTED_FIRST_TEXTURE_SHAPE
+    assert first['levels'] == EXPECTED_FIRST_DECOMPOSITION_LEVELS
+
+    indices = entries.select_indices()
+    alpha = metadata.select(indices, alpha=True)
+    assert len(alpha) == EXPECTED_ALPHA_COUNT
+    largest = metadata.sort_by_area(indices)
+    areas = metadata.width[largest].astype(int) * metadata.height[largest]
+    assert list(areas) == sorted(areas, reverse=True)
+
+def test_j2c_metadata_marker_walk(texture_fetcher):
+    head = bytes(texture_fetcher.read_texture_cache(0))
+    siz_end = 4 + int.from_bytes(head[4:6], 'big')
+    comment = b'\xff\x64\x00\x06\x00\x01ab'
+    moved = (head[:siz_end] + comment + head[siz_end:])[:TEXTURE_CACHE_BYTE_COUNT]
+    inline, walked = parse_j2c_heads(head + moved, 2, TEXTURE_CACHE_BYTE_COUNT)
+    assert walked['levels'] == inline['levels'] and walked['layers'] == inline['layers']
+
+def test_thumbnail_decode_parameters():
+    assert thumbnail_decode_parameters(1024, 1024, 5, 1, target_size=128) == (3, 0)
+    assert thumbnail_decode_parameters(1000, 250, 5, 1, target_size=128) == (2, 0)
+    assert thumbnail_decode_parameters(64, 64, 5, 1, target_size=128) == (0, 0)
+    assert thumbnail_decode_parameters(4096, 4096, 2, 1, target_size=128) == (2, 0)
+    assert thumbnail_decode_parameters(256, 256, 5, 6, target_size=128, layer_fraction=0.5) == (1, 3)
+
+def test_thumbnail_store_variant(tmp_path, texture_fetcher):
+    entry = texture_fetcher.load_entry_table()[0]
+    path = str(tmp_path / 'thumbnails.sqlite')
+    store = ThumbnailStore(path, 1024 * 1024, 'target=128')
+    store.put(entry, np.zeros((4, 4, 4), dtype=np.uint8))
+    store.close()
+    for variant, stored in (('target=128', True), ('target=64', False)):
+        store = ThumbnailStore(path, 1024 * 1024, variant)
+        assert (store.get(entry) is not None) == stored
+        store.close()
+
+class SlowJ2CDecoder(j2c.PillowJ2CDecoder):
+
+    name = 'slow'
+
+    def decode(self, j2c_contents, reduce=0, layers=0):
+        time.sleep(0.01)
+        return j2c.PillowJ2CDecoder.decode(self, j2c_contents, reduce, layers)
+
+class BrokenJ2CDecoder(j2c.PillowJ2CDecoder):
+
+    name = 'broken'
+
+    def decode(self, j2c_contents, reduce=0, layers=0):
+        return np.zeros((1, 1), dtype=np.uint8)
+
+class FailingJ2CDecoder(j2c.PillowJ2CDecoder):
+
+    name = 'failing'
+
+    def decode(self, j2c_contents, reduce=0, layers=0):
+        raise OSError('broken data stream')
+
+def test_j2c_decoder_selection(tmp_path, texture_fetcher, monkeypatch):
+    decoders = dict(j2c.J2C_DECODERS)
+    decoders.update({'slow': SlowJ2CDecoder, 'broken': BrokenJ2CDecoder,
+                     'failing': FailingJ2CDecoder})
+    monkeypatch.setattr(j2c, 'J2C_DECODERS', decoders)
+    assert j2c.available_j2c_decoders()[-3:] == ['slow', 'broken', 'failing']
+
+    # benchmark samples are complete codestreams
+    contents = texture_fetcher.load_cache_file_contents()
+    entries = texture_fetcher.load_entry_table()
+    sample = texture_fetcher.load_benchmark_sample(contents, entries)
+    assert any(len(sample) == entries[i].image_size > TEXTURE_CACHE_BYTE_COUNT
+               and sample == texture_fetcher.load_codestream(contents, i, entries[i].uuid)
+               for i in entries.select_indices())
+    timings = j2c.benchmark_j2c_decoders(sample, 1, repeat=1)
+    assert timings['slow'] >= 0.01 and timings['broken'] is None and timings['failing'] is None
+
+    # the fastest correct decoder is picked and saved for later runs
+    choice_path = str(tmp_path / 'decoder.json')
+    assert j2c.select_j2c_decoder(sample, 1, name=None, choice_path=choice_path) != 'slow'
+    with open(choice_path, 'r') as choice_file:
+        choice = json.load(choice_file)
+    choice['decoder'] = 'slow'
+    with open(choice_path, 'w') as choice_file:
+        json.dump(choice, choice_file)
+    assert j2c.select_j2c_decoder(None, name=None, choice_path=choice_path) == 'slow'
+
+    # configured decoders override the saved choice
+    assert j2c.select_j2c_decoder(None, name='broken', choice_path=choice_path) == 'broken'
+    assert j2c.select_j2c_decoder(None, name='missing', choice_path=choice_path) == 'slow'
+
+    # pools select once, in this process, and save to the configured path
+    pool = decodepool.DecodePool(1)
+    selected = pool.select_decoder(sample, thumbnail=True)
+    assert selected not in ('slow', 'broken', 'failing')
+    assert j2c.get_j2c_decoder().name == selected
+    assert pool.select_decoder(None) == selected
+    with open(j2c.J2C_DECODER_CHOICE_PATH, 'r') as choice_file:
+        assert json.load(choice_file)['decoder'] == selected
+
+    # Pillow is used, and not saved, when no decoder can decode the sample
+    decoders['slow'] = FailingJ2CDecoder
+    monkeypatch.setattr(j2c.PillowJ2CDecoder, 'decode', FailingJ2CDecoder.decode)
+    failed_choice_path = str(tmp_path / 'failed.json')
+    assert j2c.select_j2c_decoder(sample, 1, name=None, choice_path=failed_choice_path) == 'pillow'
+    assert not os.path.exists(failed_choice_path)
+
+def test_mapping_release():
+    fetcher = TextureCacheFetcher(MOCK_ENTRIES_PATH, memory_mapped=True)
+    first = fetcher.load_cache_file_contents()
+    second = fetcher.load_cache_file_contents()
+    first_mapping, second_mapping = first.obj, second.obj
+
+    # replaced mappings are closed once no view of them is left
+    assert not first_mapping.closed
+    first.release()
+    third = fetcher.load_cache_file_contents()
+    third_mapping = third.obj
+    assert first_mapping.closed and not second_mapping.closed
+
+    second.release()
+    third.release()
+    fetcher.close()
+    assert second_mapping.closed and third_mapping.closed
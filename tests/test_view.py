@@ -0,0 +1,119 @@
+'''
+Tests for the thumbnail view model.
+'''
+
+import sys
+import os
+import pytest
+
+src_path = os.path.abspath(os.path.join(__file__, '../../src'))
+sys.path.append(src_path)
+
+from PyQt5 import QtCore
+from PyQt5.QtWidgets import QApplication
+
+from tconfig import *
+
+from texturefetch import TextureCacheFetchService, TextureCacheFetcher
+from view import MainWindow, ThumbnailListModel
+import backend
+
+@pytest.fixture
+def qapp():
+    app = QApplication.instance() or QApplication(sys.argv)
+    return app
+
+def test_thumbnail_model_on_demand(qapp):
+    fetch_service = TextureCacheFetchService(TextureCacheFetcher(MOCK_ENTRIES_PATH), 1)
+    model = ThumbnailListModel()
+    decoded = []
+    fetch_service.entries_available.connect(model.set_entries)
+    fetch_service.thumbnails_available.connect(decoded.extend)
+    fetch_service.thumbnails_available.connect(
+        lambda batch: model.add_thumbnails([(item.entry.index, item.uuid, item.thumbnail) for item in batch]))
+    model.thumbnails_requested.connect(fetch_service.fetch_thumbnails_for)
+
+    fetch_service.fetch_entries()
+    assert model.rowCount() == EXPECTED_ENTRY_COUNT
+    assert decoded == []
+
+    # rows are listed newest first
+    first = model.index(model.rowCount() - 1)
+    assert first.data() == EXPECTED_FIRST_UUID
+    assert first.data(QtCore.Qt.DecorationRole) is None
+    qapp.processEvents()
+    assert len(decoded) == 1
+
+    pixmap = first.data(QtCore.Qt.DecorationRole)
+    assert (pixmap.height(), pixmap.width()) == EXPECTED_FIRST_THUMBNAIL_SHAPE[:2]
+    assert len(model.pixmap_cache) == 1
+
+    fetch_service.fetch_entries(rebuild=False)
+    assert model.rowCount() == EXPECTED_ENTRY_COUNT
+    assert first.data(QtCore.Qt.DecorationRole) is not None
+
+def test_bitmap_before_thumbnail(qapp):
+    fetch_service = TextureCacheFetchService(TextureCacheFetcher(MOCK_ENTRIES_PATH), 1)
+    fetch_service.fetch_entries()
+    pixmap = fetch_service.fetch_bitmap(EXPECTED_FIRST_UUID)
+    assert pixmap.width() == EXPECTED_FIRST_TEXTURE_SHAPE[1]
+
+def test_progressive_preview(qapp):
+    fetch_service = TextureCacheFetchService(TextureCacheFetcher(MOCK_ENTRIES_PATH), 1)
+    fetch_service.fetch_entries()
+    reduce_levels = fetch_service.reader.preview_reduce_levels(EXPECTED_FIRST_UUID)
+    assert reduce_levels[-1] == 0 and reduce_levels == sorted(reduce_levels, reverse=True)
+    coarse = fetch_service.fetch_bitmap(EXPECTED_FIRST_UUID, reduce_levels[0])
+    assert coarse.width() == EXPECTED_FIRST_THUMBNAIL_SHAPE[1]
+    full = fetch_service.fetch_bitmap(EXPECTED_FIRST_UUID)
+    assert fetch_service.reader.preview_reduce_levels(EXPECTED_FIRST_UUID) == [0]
+
+    window = MainWindow()
+    requested = []
+    cancelled = []
+    window.request_preview.connect(requested.append)
+    window.cancel_preview.connect(cancelled.append)
+    window.open_preview(EXPECTED_FIRST_UUID)
+    window.open_preview(EXPECTED_FIRST_UUID)
+    assert requested == [EXPECTED_FIRST_UUID]
+
+    # coarse passes are shown at full size until refined
+    window.show_preview(EXPECTED_FIRST_UUID, coarse, reduce_levels[0])
+    preview_window = window.preview_windows[EXPECTED_FIRST_UUID]
+    assert preview_window.image_widget.pixmap().width() == full.width()
+    window.show_preview(EXPECTED_FIRST_UUID, full, 0)
+    assert preview_window.image_widget.pixmap().cacheKey() == full.cacheKey()
+
+    # passes arriving after the window closed are dropped
+    preview_window.close()
+    assert cancelled == [EXPECTED_FIRST_UUID]
+    window.show_preview(EXPECTED_FIRST_UUID, full, 0)
+    assert EXPECTED_FIRST_UUID not in window.preview_windows
+
+    # failed requests can be made again
+    window.open_preview(EXPECTED_FIRST_UUID)
+    window.preview_failed(EXPECTED_FIRST_UUID)
+    window.open_preview(EXPECTED_FIRST_UUID)
+    assert requested == [EXPECTED_FIRST_UUID] * 3
+
+def test_refresh_without_cache(qapp, tmp_path, monkeypatch):
+    window = MainWindow()
+    assert window.menu_bar.cache_actions
+    assert not any(action.isEnabled() for action in window.menu_bar.cache_actions)
+
+    # unreadable entry tables are logged and keep the previous listing
+    monkeypatch.setattr(backend, 'THUMBNAIL_STORE_ENABLED', False)
+    controller = backend.Backend()
+    listed = []
+    controller.entries_available.connect(listed.append)
+    controller.refresh()
+    controller.set_cache_path(MOCK_ENTRIES_PATH)
+    controller.rebuild(2**31)
+    assert len(listed) == 1
+    with open(str(tmp_path / 'texture.entries'), 'wb') as entries_file:
+        entries_file.write(b'\x00' * 7)
+    controller.set_cache_path(str(tmp_path / 'texture.entries'))
+    controller.refresh()
+    assert len(listed) == 1
+    controller.cancel_jobs()
+    controller.close()
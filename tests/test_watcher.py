@@ -0,0 +1,53 @@
+'''
+Tests for the texture cache watcher.
+'''
+
+import sys
+import os
+import time
+import pytest
+
+src_path = os.path.abspath(os.path.join(__file__, '../../src'))
+sys.path.append(src_path)
+
+from PyQt5.QtWidgets import QApplication
+
+from tconfig import *
+
+from watcher import TextureCacheWatcher
+
+@pytest.fixture
+def qapp():
+    app = QApplication(sys.argv)
+    return app
+
+def process_events(app, seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        app.processEvents()
+        time.sleep(0.01)
+
+def test_watcher_debounces_writes(qapp, tmp_path):
+    entries_path = tmp_path / 'texture.entries'
+    entries_path.write_bytes(b'')
+    os.mkdir(str(tmp_path / '0'))
+
+    watcher = TextureCacheWatcher(WATCH_TEST_DEBOUNCE_MS, WATCH_TEST_MAX_DELAY_MS)
+    changes = []
+    watcher.changed.connect(lambda: changes.append(True))
+    watcher.watch(str(tmp_path))
+    assert len(watcher.file_watcher.files()) == 1
+    assert len(watcher.file_watcher.directories()) == 1
+
+    for i in range(5):
+        with open(str(entries_path), 'ab') as entries_file:
+            entries_file.write(b'\0')
+        (tmp_path / '0' / ('%i.texture' % i)).write_bytes(b'\0')
+        process_events(qapp, 0.01)
+    process_events(qapp, 1.0)
+    assert changes == [True]
+
+    watcher.stop()
+    entries_path.write_bytes(b'')
+    process_events(qapp, 0.5)
+    assert changes == [True]